@@ -0,0 +1,275 @@
+"""
+Local stand-ins for paperless-ngx and lexoffice, serving just the endpoints the sync uses.
+
+Run on its own to poke at the sync by hand:
+
+    python benchmark/fake_servers.py --documents 50 --size 100000 --latency 0.2 --rate-429 0.05
+
+It prints the URLs of both fakes, as JSON on the first line.
+"""
+import re
+import sys
+import json
+import time
+import uuid
+import random
+import argparse
+import threading
+from datetime import datetime, timezone
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlsplit, parse_qs, urlencode
+
+INBOX_TAG_ID = 1
+LEXOFFICE_TAG_ID = 2
+
+
+def synthetic_pdf(doc_id, size):
+    """A minimal PDF padded with a comment to `size` bytes, unique per document."""
+    head = (
+        b"%PDF-1.4\n1 0 obj << /Type /Catalog /Pages 2 0 R >> endobj\n"
+        b"2 0 obj << /Type /Pages /Kids [] /Count 0 >> endobj\n"
+        + f"% document {doc_id}\n".encode()
+    )
+    tail = b"\ntrailer << /Root 1 0 R >>\n%%EOF\n"
+    padding = max(0, size - len(head) - len(tail))
+    return head + b"%" + b"x" * max(0, padding - 1) + tail
+
+
+def _now():
+    return datetime.now(timezone.utc).isoformat()
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    def _send(self, status, body=b"", content_type="application/json", headers=None):
+        if not isinstance(body, bytes):
+            body = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _read_body(self):
+        """
+        Returns the request body, or None for a request carrying both Content-Length and
+        Transfer-Encoding, which real servers and load balancers reject as well.
+        """
+        length = self.headers.get("Content-Length")
+        if "Transfer-Encoding" in self.headers:
+            if length is not None:
+                self.close_connection = True
+                return None
+            body = b""
+            if self.headers["Transfer-Encoding"].lower() == "chunked":
+                while (size := int(self.rfile.readline().strip(), 16)) > 0:
+                    body += self.rfile.read(size)
+                    self.rfile.readline()
+                self.rfile.readline()
+            return body
+        return self.rfile.read(int(length)) if length is not None else b""
+
+
+class FakePaperless:
+    """
+    In-memory paperless-ngx holding `count` documents of `size` bytes, all tagged with the
+    inbox and the lexoffice tag and carrying `content_size` bytes of OCR text, as real documents
+    do. Serves the document listing (honoring `fields`), downloads, PATCH and bulk edits.
+    """
+
+    def __init__(self, count, size, tag_ids=(INBOX_TAG_ID, LEXOFFICE_TAG_ID), content_size=20_000):
+        self.documents = {
+            doc_id: {
+                "id": doc_id,
+                "title": f"Invoice {doc_id}",
+                "content": "Lorem ipsum dolor sit amet. " * (content_size // 28),
+                "tags": list(tag_ids),
+                "modified": _now(),
+                "checksum": f"{doc_id:032x}",
+                "original_file_name": f"scan-{doc_id}.jpg",
+                "custom_fields": [],
+            }
+            for doc_id in range(1, count + 1)
+        }
+        self.size = size
+        self.lock = threading.Lock()
+
+    def handler(self):
+        fake = self
+
+        class Handler(_Handler):
+            def do_GET(self):
+                target = urlsplit(self.path)
+                if target.path == "/api/documents/":
+                    return self._send(200, fake.listing(self.headers["Host"], parse_qs(target.query)))
+                match = re.fullmatch(r"/api/documents/(\d+)/download/", target.path)
+                if match and int(match.group(1)) in fake.documents:
+                    return self._send(200, synthetic_pdf(int(match.group(1)), fake.size), "application/pdf")
+                match = re.fullmatch(r"/api/documents/(\d+)/", target.path)
+                if match and int(match.group(1)) in fake.documents:
+                    with fake.lock:
+                        return self._send(200, fake.documents[int(match.group(1))])
+                self._send(404, {"detail": "Not found."})
+
+            def do_PATCH(self):
+                match = re.fullmatch(r"/api/documents/(\d+)/", urlsplit(self.path).path)
+                body = self._read_body()
+                if body is None:
+                    return self._send(400, {"detail": "Content-Length and Transfer-Encoding"})
+                body = json.loads(body or b"{}")
+                if not match or int(match.group(1)) not in fake.documents:
+                    return self._send(404, {"detail": "Not found."})
+                with fake.lock:
+                    document = fake.documents[int(match.group(1))]
+                    document.update({key: value for key, value in body.items() if key in ("tags", "custom_fields")})
+                    document["modified"] = _now()
+                    self._send(200, document)
+
+            def do_POST(self):
+                if urlsplit(self.path).path != "/api/documents/bulk_edit/":
+                    return self._send(404, {"detail": "Not found."})
+                body = self._read_body()
+                if body is None:
+                    return self._send(400, {"detail": "Content-Length and Transfer-Encoding"})
+                body = json.loads(body or b"{}")
+                if body.get("method") != "remove_tag":
+                    return self._send(400, {"detail": "Unsupported method."})
+                with fake.lock:
+                    for doc_id in body.get("documents", []):
+                        document = fake.documents.get(doc_id)
+                        if document:
+                            document["tags"] = [tag for tag in document["tags"] if tag != body["parameters"]["tag"]]
+                            document["modified"] = _now()
+                self._send(200, {"result": "OK"})
+
+        return Handler
+
+    def listing(self, host, query):
+        tags = [int(tag) for tag in query.get("tags__id__all", [""])[0].split(",") if tag]
+        ids = query.get("id__in", [""])[0].split(",") if "id__in" in query else None
+        with self.lock:
+            documents = [
+                document for document in self.documents.values()
+                if all(tag in document["tags"] for tag in tags)
+                and (ids is None or str(document["id"]) in ids)
+                and document["modified"] >= query.get("modified__gte", [""])[0]
+            ]
+        if query.get("ordering") == ["modified,id"]:
+            documents.sort(key=lambda document: (document["modified"], document["id"]))
+        if "fields" in query:
+            fields = query["fields"][0].split(",")
+            documents = [{field: document[field] for field in fields if field in document} for document in documents]
+
+        page_size = int(query.get("page_size", ["25"])[0])
+        page = int(query.get("page", ["1"])[0])
+        next_url = None
+        if page * page_size < len(documents):
+            next_query = {key: values[0] for key, values in query.items()}
+            next_query["page"] = page + 1
+            next_url = f"http://{host}/api/documents/?{urlencode(next_query)}"
+        return {
+            "count": len(documents),
+            "next": next_url,
+            "results": documents[(page - 1) * page_size: page * page_size],
+        }
+
+
+class FakeLexoffice:
+    """
+    lexoffice voucher upload taking `latency` seconds per upload, which answers a share of the
+    uploads with 401 (`rate_401`) or with 429 and a Retry-After of `retry_after` seconds (`rate_429`).
+    Uploads with several documents create one voucher each, unless `reject_batches` is set.
+    Also serves the login and session check the client uses.
+    """
+
+    def __init__(self, latency=0.0, rate_401=0.0, rate_429=0.0, retry_after=1, reject_batches=False):
+        self.latency = latency
+        self.rate_401 = rate_401
+        self.rate_429 = rate_429
+        self.retry_after = retry_after
+        self.reject_batches = reject_batches
+        self.uploads = 0
+        self.requests = 0
+        self.lock = threading.Lock()
+
+    def handler(self):
+        fake = self
+
+        class Handler(_Handler):
+            def do_GET(self):
+                if urlsplit(self.path).path == "/capsa/capsa-rest/v2/vouchers":
+                    return self._send(200, [])
+                self._send(404, {})
+
+            def do_POST(self):
+                path = urlsplit(self.path).path
+                body = self._read_body()
+                if body is None:
+                    return self._send(400, {"message": "Content-Length and Transfer-Encoding"})
+                if path.endswith("/login/web/v100/authenticate"):
+                    return self._send(200, {}, headers={"Set-Cookie": f"session={uuid.uuid4().hex}; Path=/"})
+                if path != "/capsa/capsa-rest/v2/vouchers":
+                    return self._send(404, {})
+
+                time.sleep(fake.latency)
+                draw = random.random()
+                if draw < fake.rate_429:
+                    return self._send(429, {}, headers={"Retry-After": str(fake.retry_after)})
+                if draw < fake.rate_429 + fake.rate_401:
+                    return self._send(401, {})
+                filenames = re.findall(rb'name="documents"; filename="([^"]*)"', body)
+                if b"%PDF" not in body or not filenames:
+                    return self._send(400, {"message": "no document"})
+                if len(filenames) > 1 and fake.reject_batches:
+                    return self._send(400, {"message": "only one document per voucher"})
+                with fake.lock:
+                    fake.uploads += len(filenames)
+                    fake.requests += 1
+                if len(filenames) == 1:
+                    return self._send(200, {"id": str(uuid.uuid4())})
+                self._send(200, [{"id": str(uuid.uuid4()), "fileName": filename.decode()} for filename in filenames])
+
+        return Handler
+
+
+def serve(fake, port=0):
+    """Serves `fake` on a background thread, returns the server."""
+    server = ThreadingHTTPServer(("127.0.0.1", port), fake.handler())
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--documents", type=int, default=100, help="number of documents tagged for upload")
+    parser.add_argument("--size", type=int, default=200_000, help="size of every document in bytes")
+    parser.add_argument("--latency", type=float, default=0.1, help="seconds lexoffice takes per upload")
+    parser.add_argument("--rate-401", type=float, default=0.0, help="share of uploads answered with 401")
+    parser.add_argument("--rate-429", type=float, default=0.0, help="share of uploads answered with 429")
+    parser.add_argument("--retry-after", type=int, default=1, help="Retry-After sent with 429 answers")
+    parser.add_argument("--reject-batches", action="store_true", help="answer uploads of several documents with 400")
+    parser.add_argument("--paperless-port", type=int, default=0)
+    parser.add_argument("--lexoffice-port", type=int, default=0)
+    args = parser.parse_args()
+
+    paperless = serve(FakePaperless(args.documents, args.size), args.paperless_port)
+    lexoffice = serve(FakeLexoffice(args.latency, args.rate_401, args.rate_429, args.retry_after, args.reject_batches), args.lexoffice_port)
+    print(json.dumps({
+        "paperless_url": f"http://127.0.0.1:{paperless.server_port}/",
+        "lexoffice_url": f"http://127.0.0.1:{lexoffice.server_port}",
+    }), flush=True)
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,198 @@
+"""
+Measures the throughput of a full sync cycle against local fake paperless-ngx and lexoffice
+servers, see fake_servers.py. Reports documents per second, p50/p99 latencies per pipeline
+stage and per request, and the peak RSS of the sync process.
+
+    python benchmark/run.py --documents 200 --size 500000 --latency 0.2 --streaming
+    python benchmark/run.py --output results.json
+    python benchmark/run.py --baseline results.json   # fails if throughput dropped
+
+Sync settings not covered by an option are taken from the environment as usual.
+"""
+import os
+import sys
+import json
+import time
+import asyncio
+import argparse
+import resource
+import tempfile
+import subprocess
+from collections import defaultdict
+
+BENCHMARK_DIR = os.path.dirname(os.path.abspath(__file__))
+SOURCE_DIR = os.path.join(BENCHMARK_DIR, os.pardir, "source")
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--documents", type=int, default=100, help="number of documents to sync")
+    parser.add_argument("--size", type=int, default=200_000, help="size of every document in bytes")
+    parser.add_argument("--latency", type=float, default=0.1, help="seconds lexoffice takes per upload")
+    parser.add_argument("--rate-401", type=float, default=0.0, help="share of uploads answered with 401")
+    parser.add_argument("--rate-429", type=float, default=0.0, help="share of uploads answered with 429")
+    parser.add_argument("--streaming", action="store_true", help="sync with STREAMING_TRANSFER")
+    parser.add_argument("--download-concurrency", type=int, help="overrides DOWNLOAD_CONCURRENCY")
+    parser.add_argument("--upload-concurrency", type=int, help="overrides UPLOAD_CONCURRENCY")
+    parser.add_argument("--upload-rate", type=float, help="overrides UPLOAD_RATE")
+    parser.add_argument("--upload-batch-size", type=int, help="overrides UPLOAD_BATCH_SIZE")
+    parser.add_argument("--reject-batches", action="store_true", help="let the fake lexoffice reject batched uploads")
+    parser.add_argument("--output", help="write the results as JSON to this file")
+    parser.add_argument("--baseline", help="JSON results of an earlier run to compare against")
+    parser.add_argument("--tolerance", type=float, default=0.2,
+                        help="share of the baseline throughput the run may fall short of before failing")
+    return parser.parse_args()
+
+
+def configure(args):
+    """Applies the options as environment variables, before the sync modules read them on import."""
+    overrides = {
+        "STREAMING_TRANSFER": "true" if args.streaming else None,
+        "DOWNLOAD_CONCURRENCY": args.download_concurrency,
+        "UPLOAD_CONCURRENCY": args.upload_concurrency,
+        "UPLOAD_RATE": args.upload_rate,
+        "UPLOAD_BATCH_SIZE": args.upload_batch_size,
+    }
+    for name, value in overrides.items():
+        if value is not None:
+            os.environ[name] = str(value)
+    os.environ["LEXOFFICE_SESSION_STORE"] = ""  # never touch a real session
+    sys.path.insert(0, os.path.abspath(SOURCE_DIR))
+
+
+def start_fakes(args):
+    process = subprocess.Popen(
+        [
+            sys.executable, os.path.join(BENCHMARK_DIR, "fake_servers.py"),
+            "--documents", str(args.documents), "--size", str(args.size), "--latency", str(args.latency),
+            "--rate-401", str(args.rate_401), "--rate-429", str(args.rate_429),
+        ] + (["--reject-batches"] if args.reject_batches else []),
+        stdout=subprocess.PIPE, text=True,
+    )
+    return process, json.loads(process.stdout.readline())
+
+
+def record_samples(histogram, samples, key):
+    """Keeps every value observed by `histogram`, the buckets are too coarse for percentiles."""
+    observe = histogram.observe
+
+    def recording_observe(value, **labels):
+        samples[key(labels)].append(value)
+        observe(value, **labels)
+
+    histogram.observe = recording_observe
+
+
+def percentile(values, share):
+    values = sorted(values)
+    return values[min(len(values) - 1, max(0, round(share * len(values) + 0.5) - 1))]
+
+
+def peak_rss_bytes():
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if sys.platform == "darwin" else peak * 1024  # Linux reports kilobytes
+
+
+def run_benchmark(args, urls):
+    import lexoffice
+    import metrics
+    import paperless
+    from sync import TenantSync
+    from tenants import Tenant
+    from fake_servers import INBOX_TAG_ID, LEXOFFICE_TAG_ID
+
+    lexoffice.LEXOFFICE_BASE_URL = urls["lexoffice_url"]
+    lexoffice.PLAYWRIGHT_AVAILABLE = False  # log in at the fake instead of launching a browser
+
+    stage_samples, request_samples = defaultdict(list), defaultdict(list)
+    record_samples(metrics.STAGE_DURATION, stage_samples, lambda labels: labels["stage"])
+    record_samples(metrics.REQUEST_DURATION, request_samples,
+                   lambda labels: f"{labels['service']} {labels['operation']}")
+
+    tenant = Tenant(
+        "benchmark", "token", urls["paperless_url"], INBOX_TAG_ID, LEXOFFICE_TAG_ID,
+        lexoffice_username="benchmark", lexoffice_password="benchmark",
+    )
+    started = time.monotonic()
+    sync = TenantSync(tenant)
+    sync.lexoffice.prewarm()
+    asyncio.run(sync.sync())
+    duration = time.monotonic() - started
+
+    remaining = sum(1 for _ in paperless.filter_documents_by_tags(
+        "token", urls["paperless_url"], [INBOX_TAG_ID, LEXOFFICE_TAG_ID]
+    ))
+    synced = args.documents - remaining
+
+    def latencies(samples):
+        return {
+            name: {"count": len(values), "p50": percentile(values, 0.5), "p99": percentile(values, 0.99)}
+            for name, values in sorted(samples.items())
+        }
+
+    return {
+        "documents": args.documents,
+        "document_size": args.size,
+        "streaming": args.streaming,
+        "synced": synced,
+        "duration": duration,
+        "documents_per_second": synced / duration if duration else 0.0,
+        "peak_rss_bytes": peak_rss_bytes(),
+        "stages": latencies(stage_samples),
+        "requests": latencies(request_samples),
+    }
+
+
+def report(results):
+    print()
+    print(f"Synced {results['synced']}/{results['documents']} documents of {results['document_size']} bytes "
+          f"in {results['duration']:.2f}s{' (streaming)' if results['streaming'] else ''}")
+    print(f"Throughput: {results['documents_per_second']:.2f} documents/s")
+    print(f"Peak RSS:   {results['peak_rss_bytes'] / 1024 / 1024:.1f} MiB")
+    for title, latencies in (("Stage", results["stages"]), ("Request", results["requests"])):
+        print()
+        print(f"{title:<28} {'count':>7} {'p50 (s)':>9} {'p99 (s)':>9}")
+        for name, latency in latencies.items():
+            print(f"{name:<28} {latency['count']:>7} {latency['p50']:>9.3f} {latency['p99']:>9.3f}")
+
+
+def main():
+    args = parse_args()
+    configure(args)
+    sys.path.insert(0, BENCHMARK_DIR)
+
+    process, urls = start_fakes(args)
+    cwd = os.getcwd()
+    try:
+        # The journal, lock and tmp files of the sync go into a scratch directory
+        with tempfile.TemporaryDirectory() as workdir:
+            os.chdir(workdir)
+            try:
+                results = run_benchmark(args, urls)
+            finally:
+                os.chdir(cwd)
+    finally:
+        process.terminate()
+        process.wait()
+
+    report(results)
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)["documents_per_second"]
+        floor = baseline * (1 - args.tolerance)
+        print()
+        print(f"Baseline:   {baseline:.2f} documents/s, this run may not fall below {floor:.2f}")
+        if results["documents_per_second"] < floor:
+            print("Throughput regressed.")
+            return 1
+    if results["synced"] < results["documents"]:
+        print(f"Warning: {results['documents'] - results['synced']} documents were not synced.")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
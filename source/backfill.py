@@ -0,0 +1,153 @@
+import os
+import json
+import time
+import asyncio
+import paperless
+from concurrent.futures import ThreadPoolExecutor
+from journal import WRITTEN_BACK
+
+CHECKPOINT_FILE = "backfill.json"
+PROGRESS_INTERVAL = 5  # seconds between progress lines and checkpoints
+LOCK_WAIT_INTERVAL = 5  # seconds between checks whether the running sync released its lock
+BACKFILL_CONCURRENCY = int(os.getenv("BACKFILL_CONCURRENCY", 8))
+
+
+def _format_duration(seconds):
+    minutes, seconds = divmod(int(seconds), 60)
+    hours, minutes = divmod(minutes, 60)
+    return f"{hours}h{minutes:02d}m{seconds:02d}s" if hours else f"{minutes}m{seconds:02d}s"
+
+
+class Checkpoint:
+    """
+    Progress of a backfill, persisted as JSON so an interrupted backfill resumes where it
+    stopped: the selection it was started with and the IDs of the documents already synced.
+    A checkpoint of a different selection is discarded.
+    """
+
+    def __init__(self, path, selection):
+        self.path = path
+        self.selection = selection
+        self.done = set()
+
+        if os.path.exists(path):
+            try:
+                with open(path) as f:
+                    state = json.load(f)
+                if state.get("selection") == selection:
+                    self.done = set(state.get("done", []))
+                else:
+                    print(f"[Backfill] Checkpoint {path} belongs to another selection, starting over")
+            except (OSError, ValueError) as e:
+                print(f"[Backfill] Could not read checkpoint {path}, starting over: {e}")
+
+    def save(self):
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump({"selection": self.selection, "done": sorted(self.done)}, f)
+        os.replace(tmp_path, self.path)
+
+
+class Backfill:
+    """
+    One-shot sync of historical documents selected by full text query, tags and creation date,
+    whether or not they carry the lexoffice tag. Runs the regular pipeline of the tenant with
+    higher concurrency, reporting progress and checkpointing the synced documents.
+    Like a sync cycle it holds the tenant's lock, unless documents are claimed with leases,
+    so it never works on the same documents as the running service.
+    """
+
+    def __init__(self, sync, query=None, tags=None, created_after=None, created_before=None,
+                 checkpoint_path=None, concurrency=BACKFILL_CONCURRENCY):
+        self.sync = sync
+        self.selection = {
+            "query": query,
+            "tags": sorted(str(tag) for tag in tags or []),
+            "created_after": created_after,
+            "created_before": created_before,
+        }
+        self.checkpoint = Checkpoint(checkpoint_path or sync.tenant.path(CHECKPOINT_FILE), self.selection)
+        self.concurrency = concurrency
+
+    async def run(self):
+        """Syncs the selected documents and prints a summary. Returns True if none of them failed."""
+        if self.sync.leases:
+            return await self._run()
+
+        if self.sync.is_locked():
+            print("[Backfill] Waiting for the running sync to finish its cycle...")
+            while self.sync.is_locked():
+                await asyncio.sleep(LOCK_WAIT_INTERVAL)
+        self.sync.create_lock()
+        try:
+            return await self._run()
+        finally:
+            self.sync.remove_lock()
+
+    async def _run(self):
+        # A thread for every worker of the three stages, the default executor would cap them far lower
+        with ThreadPoolExecutor(self.concurrency * 3, thread_name_prefix="backfill") as executor:
+            pipeline = self.sync.make_pipeline(
+                download_concurrency=self.concurrency,
+                upload_concurrency=self.concurrency,
+                writeback_concurrency=self.concurrency,
+                queue_size=self.concurrency * 2,
+                executor=executor,
+            )
+            return await self._backfill(pipeline)
+
+    async def _backfill(self, pipeline):
+        tenant = self.sync.tenant
+        print(f"[Backfill] Listing documents matching {self.selection}...")
+        documents = await asyncio.to_thread(lambda: [
+            document["id"] for document in pipeline.remember(paperless.list_documents(
+                tenant.paperless_token, tenant.paperless_url, self.selection["tags"], ordering="id",
+                query=self.selection["query"], created_after=self.selection["created_after"],
+                created_before=self.selection["created_before"],
+            ))
+        ])
+        pending = [doc_id for doc_id in documents if not self._synced(doc_id)]
+        already_done = len(documents) - len(pending)
+        print(f"[Backfill] {len(documents)} documents selected, {already_done} already synced, {len(pending)} to go")
+
+        started = time.monotonic()
+        seen = set()
+        progress = asyncio.create_task(self._report_progress(pipeline, len(pending), started))
+        try:
+            await pipeline.run(iter(pending), skip=seen, completed=self.checkpoint.done)
+        finally:
+            progress.cancel()
+            self.checkpoint.save()
+
+        duration = time.monotonic() - started
+        synced = len(seen & self.checkpoint.done)
+        failed = sorted(seen - self.checkpoint.done)
+        print("[Backfill] Summary")
+        print(f"[Backfill]   selected:   {len(documents)}")
+        print(f"[Backfill]   skipped:    {already_done} (synced earlier)")
+        print(f"[Backfill]   synced:     {synced} ({pipeline.duplicates} linked to existing vouchers)")
+        print(f"[Backfill]   not synced: {len(failed)}{f' {failed}' if failed else ''}")
+        print(f"[Backfill]   duration:   {_format_duration(duration)}, {synced / duration if duration else 0:.2f} documents/s")
+        if pipeline.stage_stats:
+            print(f"[Backfill]   stages:     {pipeline.summary()}")
+        return not failed
+
+    def _synced(self, doc_id):
+        """True for documents synced by an earlier backfill or, according to the journal, by the regular sync."""
+        if doc_id in self.checkpoint.done:
+            return True
+        job = self.sync.journal.get(doc_id) if self.sync.journal else None
+        return bool(job and job["stage"] == WRITTEN_BACK)
+
+    async def _report_progress(self, pipeline, total, started):
+        """Prints the throughput and ETA and checkpoints the synced documents every PROGRESS_INTERVAL seconds."""
+        while True:
+            await asyncio.sleep(PROGRESS_INTERVAL)
+            # Write-backs go out in batches, so documents count as soon as they are uploaded
+            uploaded = max(pipeline.stage_stats.get(stage, [0])[0] for stage in ("upload", "transfer"))
+            processed = min(uploaded + pipeline.failures, total)
+            rate = uploaded / (time.monotonic() - started)
+            eta = _format_duration((total - processed) / rate) if rate else "unknown"
+            print(f"[Backfill] {processed}/{total} documents ({processed / max(total, 1):.0%}), "
+                  f"{rate:.2f} documents/s, {pipeline.failures} failures, ETA {eta}")
+            await asyncio.to_thread(self.checkpoint.save)
@@ -0,0 +1,66 @@
+import os
+import time
+import threading
+
+BREAKER_FAILURE_THRESHOLD = int(os.getenv("BREAKER_FAILURE_THRESHOLD", 3))  # consecutive failures opening the breaker
+BREAKER_COOLDOWN = int(os.getenv("BREAKER_COOLDOWN", 300))  # seconds before a probe is let through
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half-open"
+
+
+class CircuitBreaker:
+    """
+    Tracks the health of a remote service. After `failure_threshold` consecutive failures the
+    breaker opens and callers should not even prepare requests. Once `cooldown` seconds passed
+    it turns half-open and lets a single probe through: its success closes the breaker again,
+    its failure re-opens it for another cooldown. A probe that never reports back is replaced
+    after a further cooldown, one that is abandoned before reaching the service right away.
+    """
+
+    def __init__(self, name, failure_threshold=BREAKER_FAILURE_THRESHOLD, cooldown=BREAKER_COOLDOWN):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.cooldown = cooldown
+        self.state = CLOSED
+        self._failures = 0
+        self._opened_at = 0.0
+        self._probe_started = 0.0
+        self._lock = threading.Lock()
+
+    def allow_request(self):
+        with self._lock:
+            now = time.monotonic()
+            if self.state == CLOSED:
+                return True
+            if self.state == OPEN and now - self._opened_at >= self.cooldown:
+                print(f"[Breaker] {self.name} cooldown over, letting a probe through")
+                self.state = HALF_OPEN
+                self._probe_started = now
+                return True
+            if self.state == HALF_OPEN and now - self._probe_started >= self.cooldown:
+                self._probe_started = now
+                return True
+            return False
+
+    def release_probe(self):
+        """Lets the next caller probe, for a probe that ended without a request to the service."""
+        with self._lock:
+            if self.state == HALF_OPEN:
+                self._probe_started = time.monotonic() - self.cooldown
+
+    def record_success(self):
+        with self._lock:
+            if self.state != CLOSED:
+                print(f"[Breaker] {self.name} is healthy again, closing breaker")
+            self.state = CLOSED
+            self._failures = 0
+
+    def record_failure(self):
+        with self._lock:
+            self._failures += 1
+            if self.state == HALF_OPEN or (self.state == CLOSED and self._failures >= self.failure_threshold):
+                print(f"[Breaker] {self.name} failed {self._failures} time(s) in a row, opening breaker for {self.cooldown} seconds")
+                self.state = OPEN
+                self._opened_at = time.monotonic()
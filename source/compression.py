@@ -0,0 +1,99 @@
+import os
+import io
+import threading
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
+# Try to import the PDF dependencies
+PIKEPDF_AVAILABLE = False
+try:
+    import pikepdf
+    import PIL  # pikepdf decodes images through Pillow
+    PIKEPDF_AVAILABLE = True
+except ImportError:
+    pass
+
+COMPRESS_PDFS = os.getenv("COMPRESS_PDFS", "false").lower() == "true"
+COMPRESS_MIN_SIZE = int(os.getenv("COMPRESS_MIN_SIZE", 2 * 1024 * 1024))  # bytes, smaller documents are uploaded as they are
+COMPRESS_QUALITY = int(os.getenv("COMPRESS_QUALITY", 75))  # JPEG quality of recompressed images, 1-95
+COMPRESS_MAX_IMAGE_SIZE = int(os.getenv("COMPRESS_MAX_IMAGE_SIZE", 2480))  # pixels, longest image side (A4 at 300 dpi)
+COMPRESS_WORKERS = int(os.getenv("COMPRESS_WORKERS", os.cpu_count() or 1))
+
+if COMPRESS_PDFS and not PIKEPDF_AVAILABLE:
+    print("[Compression] Warning: pikepdf or Pillow not available. PDF compression disabled. "
+          "Install with: pip install pikepdf Pillow")
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def is_enabled():
+    return COMPRESS_PDFS and PIKEPDF_AVAILABLE
+
+
+def get_pool():
+    """Returns the process pool compressing documents, created on first use."""
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            # By now the process runs threads holding locks, a forked child could inherit one held forever
+            context = multiprocessing.get_context("forkserver" if "forkserver" in multiprocessing.get_all_start_methods() else "spawn")
+            _pool = ProcessPoolExecutor(max_workers=COMPRESS_WORKERS, mp_context=context)
+        return _pool
+
+
+def _recompress_image(image_object, quality, max_image_size):
+    """
+    Replaces an embedded image by a downsampled JPEG if that is smaller. Images with masks,
+    decode arrays or unusual color spaces are left alone, a JPEG cannot represent them.
+    """
+    if any(key in image_object for key in ("/SMask", "/Mask", "/Decode")) or image_object.get("/ImageMask", False):
+        return
+    if image_object.get("/ColorSpace") not in (pikepdf.Name.DeviceRGB, pikepdf.Name.DeviceGray):
+        return
+
+    image = pikepdf.PdfImage(image_object).as_pil_image()
+    image = image.convert("L" if image.mode in ("1", "L") else "RGB")
+    image.thumbnail((max_image_size, max_image_size))
+
+    output = io.BytesIO()
+    image.save(output, format="JPEG", quality=quality, optimize=True)
+    if output.tell() >= len(image_object.read_raw_bytes()):
+        return
+
+    image_object.write(output.getvalue(), filter=pikepdf.Name.DCTDecode)
+    image_object.Width, image_object.Height = image.size
+    image_object.ColorSpace = pikepdf.Name.DeviceGray if image.mode == "L" else pikepdf.Name.DeviceRGB
+    image_object.BitsPerComponent = 8
+    if "/DecodeParms" in image_object:
+        del image_object["/DecodeParms"]
+
+
+def compress_pdf(source, destination, quality=COMPRESS_QUALITY, max_image_size=COMPRESS_MAX_IMAGE_SIZE):
+    """
+    Writes a smaller version of the PDF `source` to `destination`: embedded images are
+    downsampled and recompressed as JPEG, unreferenced objects are dropped and the file
+    is linearized. Runs in a worker process. Returns the size of `destination` in bytes.
+    """
+    with pikepdf.open(source) as pdf:
+        done = set()
+        for page in pdf.pages:
+            # get_images() replaces `images` in newer pikepdf and also finds images in form XObjects
+            images = page.get_images() if hasattr(page, "get_images") else page.images
+            for image_object in images.values():
+                if image_object.objgen in done:
+                    continue  # shared by several pages
+                done.add(image_object.objgen)
+                try:
+                    _recompress_image(image_object, quality, max_image_size)
+                except Exception as e:
+                    # Exotic image encodings are kept as they are
+                    print(f"[Compression] Keeping an image of {source} as it is: {e}")
+        pdf.remove_unreferenced_resources()
+        pdf.save(
+            destination,
+            linearize=True,
+            compress_streams=True,
+            object_stream_mode=pikepdf.ObjectStreamMode.generate,
+        )
+    return os.path.getsize(destination)
@@ -0,0 +1,81 @@
+import os
+import time
+import sqlite3
+import hashlib
+import threading
+
+DEDUPE_UPLOADS = os.getenv("DEDUPE_UPLOADS", "false").lower() == "true"
+DEDUPE_FILE = os.getenv("DEDUPE_FILE", "dedupe.db")
+DEDUPE_MAX_ENTRIES = int(os.getenv("DEDUPE_MAX_ENTRIES", 10000))
+
+
+class DuplicateContent(Exception):
+    """Raised while streaming a document whose content was already uploaded as `voucher_id`."""
+
+    def __init__(self, voucher_id):
+        super().__init__(f"content already uploaded as voucher {voucher_id}")
+        self.voucher_id = voucher_id
+
+
+def new_hash():
+    return hashlib.sha256()
+
+
+class DedupeIndex:
+    """
+    Persistent index from the SHA-256 of uploaded documents to their lexoffice voucher ID,
+    so the same PDF imported into paperless more than once is uploaded only once.
+    Holds at most `max_entries` hashes, evicting the least recently used ones.
+    Safe to use from the upload worker threads.
+    """
+
+    def __init__(self, path=DEDUPE_FILE, max_entries=DEDUPE_MAX_ENTRIES):
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self.connection = sqlite3.connect(path, isolation_level=None, check_same_thread=False)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("""
+            CREATE TABLE IF NOT EXISTS hashes (
+                digest TEXT PRIMARY KEY,
+                voucher_id TEXT NOT NULL,
+                last_used REAL NOT NULL
+            )
+        """)
+        self.connection.execute("CREATE INDEX IF NOT EXISTS hashes_last_used ON hashes (last_used)")
+
+    def close(self):
+        self.connection.close()
+
+    def lookup(self, digest):
+        """Returns the voucher ID the content was uploaded as, or None."""
+        with self._lock:
+            row = self.connection.execute("SELECT voucher_id FROM hashes WHERE digest = ?", (digest,)).fetchone()
+            if row is None:
+                return None
+            self.connection.execute("UPDATE hashes SET last_used = ? WHERE digest = ?", (time.time(), digest))
+            return row[0]
+
+    def add(self, digest, voucher_id):
+        with self._lock:
+            self.connection.execute(
+                "INSERT OR REPLACE INTO hashes (digest, voucher_id, last_used) VALUES (?, ?, ?)",
+                (digest, voucher_id, time.time())
+            )
+            self.connection.execute("""
+                DELETE FROM hashes WHERE digest IN (
+                    SELECT digest FROM hashes ORDER BY last_used DESC LIMIT -1 OFFSET ?
+                )
+            """, (self.max_entries,))
+
+    def hashing(self, chunks, hasher):
+        """
+        Passes `chunks` through while feeding them to `hasher`. Once the last chunk went by,
+        raises DuplicateContent if the content is already known, before the upload is finished.
+        """
+        for chunk in chunks:
+            hasher.update(chunk)
+            yield chunk
+
+        voucher_id = self.lookup(hasher.hexdigest())
+        if voucher_id:
+            raise DuplicateContent(voucher_id)
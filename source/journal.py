@@ -0,0 +1,94 @@
+import os
+import time
+import sqlite3
+
+JOURNAL_FILE = os.getenv("JOURNAL_FILE", "journal.db")
+RETRY_BASE_DELAY = int(os.getenv("RETRY_BASE_DELAY", 60))  # seconds, doubled on every failed attempt
+RETRY_MAX_DELAY = int(os.getenv("RETRY_MAX_DELAY", 3600))  # seconds
+
+DOWNLOADED = "downloaded"
+UPLOADED = "uploaded"
+WRITTEN_BACK = "written_back"
+
+
+class Journal:
+    """
+    Durable record of how far every document got through the sync, kept in SQLite.
+    A document is `downloaded`, then `uploaded` (with its lexoffice voucher ID), then
+    `written_back` to paperless. After a crash or a failed write-back only the missing steps
+    are replayed, so a document is never uploaded twice. Failed attempts are retried with
+    exponential backoff.
+    The journal is local to one worker: it is used from the event loop, which must not wait on
+    a file other workers lock. Workers sharing a backlog hand over uploads through their leases.
+    """
+
+    def __init__(self, path=JOURNAL_FILE, retry_base_delay=RETRY_BASE_DELAY, retry_max_delay=RETRY_MAX_DELAY):
+        self.retry_base_delay = retry_base_delay
+        self.retry_max_delay = retry_max_delay
+        self.connection = sqlite3.connect(path, isolation_level=None)
+        self.connection.row_factory = sqlite3.Row
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("""
+            CREATE TABLE IF NOT EXISTS jobs (
+                document_id INTEGER PRIMARY KEY,
+                stage TEXT,
+                voucher_id TEXT,
+                attempts INTEGER NOT NULL DEFAULT 0,
+                next_attempt_at REAL NOT NULL DEFAULT 0,
+                last_error TEXT,
+                updated_at REAL NOT NULL
+            )
+        """)
+
+    def close(self):
+        self.connection.close()
+
+    def get(self, document_id):
+        row = self.connection.execute("SELECT * FROM jobs WHERE document_id = ?", (document_id,)).fetchone()
+        return dict(row) if row else None
+
+    def is_due(self, job):
+        return job is None or job["next_attempt_at"] <= time.time()
+
+    def _set_stage(self, document_id, stage, voucher_id=None, reset_attempts=True):
+        """
+        Moves the document to `stage`. Failed attempts are only forgotten with `reset_attempts`,
+        for stages that are real progress: downloading again is part of every retry.
+        """
+        reset = "attempts = 0, next_attempt_at = 0, last_error = NULL," if reset_attempts else ""
+        self.connection.execute(f"""
+            INSERT INTO jobs (document_id, stage, voucher_id, attempts, next_attempt_at, last_error, updated_at)
+            VALUES (?, ?, ?, 0, 0, NULL, ?)
+            ON CONFLICT (document_id) DO UPDATE SET
+                stage = excluded.stage,
+                voucher_id = COALESCE(excluded.voucher_id, jobs.voucher_id),
+                {reset} updated_at = excluded.updated_at
+        """, (document_id, stage, voucher_id, time.time()))
+
+    def mark_downloaded(self, document_id):
+        self._set_stage(document_id, DOWNLOADED, reset_attempts=False)
+
+    def mark_uploaded(self, document_id, voucher_id):
+        self._set_stage(document_id, UPLOADED, voucher_id)
+
+    def mark_written_back(self, document_id):
+        self._set_stage(document_id, WRITTEN_BACK)
+
+    def restart(self, document_id):
+        """Forgets a finished job, for documents tagged for upload again after they were synced."""
+        self.connection.execute("DELETE FROM jobs WHERE document_id = ?", (document_id,))
+
+    def mark_failed(self, document_id, error):
+        """Records a failed attempt and schedules the next one with exponential backoff."""
+        job = self.get(document_id)
+        attempts = (job["attempts"] if job else 0) + 1
+        delay = min(self.retry_base_delay * 2 ** (attempts - 1), self.retry_max_delay)
+        now = time.time()
+        self.connection.execute("""
+            INSERT INTO jobs (document_id, stage, attempts, next_attempt_at, last_error, updated_at)
+            VALUES (?, NULL, ?, ?, ?, ?)
+            ON CONFLICT (document_id) DO UPDATE SET
+                attempts = excluded.attempts, next_attempt_at = excluded.next_attempt_at,
+                last_error = excluded.last_error, updated_at = excluded.updated_at
+        """, (document_id, attempts, now + delay, str(error)[:500], now))
+        print(f"[Journal] Document #{document_id} failed {attempts} time(s), next attempt in {delay} seconds: {error}")
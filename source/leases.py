@@ -0,0 +1,88 @@
+import os
+import time
+import socket
+import sqlite3
+import threading
+
+LEASE_FILE = os.getenv("LEASE_FILE")  # shared SQLite file, enables running several workers
+LEASE_TTL = int(os.getenv("LEASE_TTL", 300))  # seconds a claim is valid without renewal
+WORKER_ID = os.getenv("WORKER_ID") or f"{socket.gethostname()}-{os.getpid()}"
+
+
+class LeaseStore:
+    """
+    Time-limited claims on documents, kept in a SQLite file shared by all workers, so several
+    instances can split one backlog without uploading a document twice. A worker renews its
+    leases while it works on the documents; leases of a crashed worker expire after `ttl`
+    seconds and are taken over by whichever worker lists the document next.
+    Once a document is uploaded its lease records the voucher ID and is only released after the
+    write-back, so a worker taking it over writes back instead of uploading it again.
+    Leases are scoped, so tenants with overlapping document IDs do not collide.
+    """
+
+    def __init__(self, path=LEASE_FILE, scope="default", ttl=LEASE_TTL, owner=WORKER_ID):
+        self.scope = scope
+        self.ttl = ttl
+        self.owner = owner
+        self._lock = threading.Lock()
+        # No WAL: its shared memory index does not work for workers on different hosts
+        self.connection = sqlite3.connect(path, timeout=30, isolation_level=None, check_same_thread=False)
+        self.connection.execute("""
+            CREATE TABLE IF NOT EXISTS leases (
+                scope TEXT NOT NULL,
+                document_id INTEGER NOT NULL,
+                owner TEXT NOT NULL,
+                expires_at REAL NOT NULL,
+                voucher_id TEXT,
+                PRIMARY KEY (scope, document_id)
+            )
+        """)
+        columns = [row[1] for row in self.connection.execute("PRAGMA table_info(leases)")]
+        if "voucher_id" not in columns:
+            self.connection.execute("ALTER TABLE leases ADD COLUMN voucher_id TEXT")
+
+    def close(self):
+        self.connection.close()
+
+    def claim(self, document_id):
+        """Claims the document for this worker. Returns False if another worker holds a valid lease."""
+        now = time.time()
+        with self._lock:
+            cursor = self.connection.execute("""
+                INSERT INTO leases (scope, document_id, owner, expires_at) VALUES (?, ?, ?, ?)
+                ON CONFLICT (scope, document_id) DO UPDATE SET owner = excluded.owner, expires_at = excluded.expires_at
+                WHERE leases.owner = excluded.owner OR leases.expires_at < ?
+            """, (self.scope, document_id, self.owner, now + self.ttl, now))
+            return cursor.rowcount == 1
+
+    def renew(self):
+        """Extends all leases held by this worker. Returns their number."""
+        with self._lock:
+            cursor = self.connection.execute(
+                "UPDATE leases SET expires_at = ? WHERE scope = ? AND owner = ?",
+                (time.time() + self.ttl, self.scope, self.owner)
+            )
+            return cursor.rowcount
+
+    def record_upload(self, document_id, voucher_id):
+        """Remembers the voucher the document was uploaded as, for whoever writes it back."""
+        with self._lock:
+            self.connection.execute(
+                "UPDATE leases SET voucher_id = ? WHERE scope = ? AND document_id = ? AND owner = ?",
+                (voucher_id, self.scope, document_id, self.owner)
+            )
+
+    def uploaded_voucher(self, document_id):
+        """Returns the voucher ID recorded for the document by any worker, or None."""
+        with self._lock:
+            row = self.connection.execute(
+                "SELECT voucher_id FROM leases WHERE scope = ? AND document_id = ?", (self.scope, document_id)
+            ).fetchone()
+            return row[0] if row else None
+
+    def release(self, document_id):
+        with self._lock:
+            self.connection.execute(
+                "DELETE FROM leases WHERE scope = ? AND document_id = ? AND owner = ?",
+                (self.scope, document_id, self.owner)
+            )
@@ -1,20 +1,47 @@
 import os
 import requests
 import urllib.parse
-from time import sleep
+import tempfile
+import uuid
+import time
 import threading
-
-# Try to import Playwright dependencies
-PLAYWRIGHT_AVAILABLE = False
-try:
-    from playwright.sync_api import sync_playwright
-    PLAYWRIGHT_AVAILABLE = True
-except ImportError as e:
-    print(f"[Lexoffice] Warning: Playwright not available. AWS WAF bypass disabled. Error: {e}")
+import importlib.util
+import contextlib
+from session_store import SessionStore
+from ratelimit import AdaptiveRateLimiter, parse_retry_after
+from breaker import CircuitBreaker
+import metrics
+
+# Playwright is only imported once a browser login is needed, it is slow to import
+PLAYWRIGHT_AVAILABLE = importlib.util.find_spec("playwright") is not None
+if not PLAYWRIGHT_AVAILABLE:
+    print("[Lexoffice] Warning: Playwright not available. AWS WAF bypass disabled.")
 
 LEXOFFICE_BASE_URL = "https://app.lexware.de"
-_session = None
-_waf_cookies = None
+CHUNK_SIZE = int(os.getenv("STREAM_CHUNK_SIZE", 65536))  # bytes
+SPOOL_MAX_SIZE = int(os.getenv("STREAM_SPOOL_MAX_SIZE", 8 * 1024 * 1024))  # bytes kept in memory before spooling to disk
+SESSION_CHECK_PATH = os.getenv("LEXOFFICE_SESSION_CHECK_PATH", "capsa/capsa-rest/v2/vouchers")
+DEFAULT_TIMEOUT = int(os.getenv("DEFAULT_TIMEOUT", 10))  # seconds
+THROTTLE_RETRIES = int(os.getenv("UPLOAD_THROTTLE_RETRIES", 5))  # times a throttled upload is repeated
+THROTTLE_STATUS_CODES = (429, 503)
+LOGIN_TIMEOUT = int(os.getenv("LEXOFFICE_LOGIN_TIMEOUT", 60))  # seconds a browser login may take
+BROWSER_CLOSE_GRACE = 10  # seconds, on top of LOGIN_TIMEOUT
+PREWARM_LOGIN = os.getenv("LEXOFFICE_PREWARM_LOGIN", "true").lower() == "true"
+UPLOAD_BATCH_SIZE = int(os.getenv("UPLOAD_BATCH_SIZE", 1))  # documents per upload request, 1 disables batching
+UPLOAD_BATCH_MAX_BYTES = int(os.getenv("UPLOAD_BATCH_MAX_BYTES", 20 * 1024 * 1024))  # bytes per batched request
+
+USERNAME_SELECTOR = "input[type='email'], input[name='username'], input[name='email']"
+CONSENT_SELECTOR = ", ".join([
+    'button[data-testid="uc-accept-all-button"]',
+    'button:has-text("Alle akzeptieren")',
+    'button:has-text("Akzeptieren")',
+    'button:has-text("Accept")',
+    '#usercentrics-root button',
+])
+
+_clients = {}
+_clients_lock = threading.Lock()
+_browser_lock = threading.Lock()  # at most one headless Chromium at a time, even with many accounts
 
 BROWSER_HEADERS = {
     "accept": "application/json, text/plain, */*",
@@ -33,12 +60,25 @@ BROWSER_HEADERS = {
 }
 
 def _run_playwright_in_thread(username, password, result_container):
-    """Helper function to run Playwright in a separate thread to avoid asyncio conflicts."""
+    """
+    Helper function to run Playwright in a separate thread to avoid asyncio conflicts.
+    Every step waits for the page to reach the state it needs instead of sleeping, all of
+    them within LOGIN_TIMEOUT seconds together.
+    """
+    deadline = time.monotonic() + LOGIN_TIMEOUT
+
+    def remaining_ms(share=1.0):
+        """Milliseconds a step may take: `share` of what is left until the deadline."""
+        return max(1, int((deadline - time.monotonic()) * 1000 * share))
+
     try:
+        from playwright.sync_api import sync_playwright, TimeoutError as PlaywrightTimeoutError
+
         with sync_playwright() as p:
             # Launch browser with stealth settings
             browser = p.chromium.launch(
                 headless=True,
+                timeout=remaining_ms(),
                 args=[
                     '--disable-blink-features=AutomationControlled',
                     '--no-sandbox',
@@ -65,54 +105,33 @@ def _run_playwright_in_thread(username, password, result_container):
             """)
 
             page = context.new_page()
+            page.set_default_timeout(remaining_ms())
 
             # Navigate to login page
             login_url = urllib.parse.urljoin(LEXOFFICE_BASE_URL, 'sign-in/authenticate')
             print(f"[Lexoffice] Navigating to {login_url}")
 
-            page.goto(login_url, wait_until='domcontentloaded', timeout=30000)
-
-            # Wait for page to load
-            sleep(2)
+            page.goto(login_url, wait_until='domcontentloaded', timeout=remaining_ms())
             print(f"[Lexoffice] Current URL: {page.url}")
-            print(f"[Lexoffice] Page title: {page.title()}")
 
-            # Wait for AWS WAF challenge to complete
+            # The AWS WAF challenge page reloads into the login form once solved
             print("[Lexoffice] Waiting for AWS WAF challenge to resolve...")
-            sleep(5)
+            try:
+                page.wait_for_selector(USERNAME_SELECTOR, state='visible', timeout=remaining_ms(0.5))
+            except PlaywrightTimeoutError:
+                print(f"[Lexoffice] Login form did not appear (title: {page.title()}), reloading...")
+                page.reload(wait_until='domcontentloaded', timeout=remaining_ms())
 
             print(f"[Lexoffice] After WAF wait - URL: {page.url}")
             print(f"[Lexoffice] Page title: {page.title()}")
 
-            # Check if we got past WAF
-            if '403' in page.title() or 'Forbidden' in page.title():
-                print("[Lexoffice] Still blocked by WAF, trying longer wait...")
-                sleep(10)
-                page.reload(wait_until='domcontentloaded')
-                sleep(5)
-
             # Handle cookie consent banner if present
             try:
-                # Try to find and dismiss cookie consent
-                print("[Lexoffice] Checking for cookie consent banner...")
-                # Common cookie consent button selectors
-                consent_selectors = [
-                    'button:has-text("Accept")',
-                    'button:has-text("Akzeptieren")',
-                    'button:has-text("Alle akzeptieren")',
-                    'button[data-testid="uc-accept-all-button"]',
-                    '#usercentrics-root button',
-                ]
-
-                for selector in consent_selectors:
-                    try:
-                        if page.locator(selector).count() > 0:
-                            page.click(selector, timeout=2000)
-                            print(f"[Lexoffice] Clicked cookie consent with selector: {selector}")
-                            sleep(1)
-                            break
-                    except:
-                        continue
+                consent = page.locator(CONSENT_SELECTOR).first
+                if consent.is_visible():
+                    consent.click(timeout=min(2000, remaining_ms()))
+                    consent.wait_for(state='hidden', timeout=min(5000, remaining_ms()))
+                    print("[Lexoffice] Dismissed cookie consent banner")
             except Exception as e:
                 print(f"[Lexoffice] No cookie consent banner found or error dismissing: {e}")
 
@@ -120,23 +139,13 @@ def _run_playwright_in_thread(username, password, result_container):
             print("[Lexoffice] Attempting login...")
 
             try:
-                # Try different selectors for username field
-                selectors = [
-                    "input[type='email']",
-                    "input[name='username']",
-                    "input[name='email']"
-                ]
-
                 username_filled = False
-                for selector in selectors:
-                    try:
-                        page.wait_for_selector(selector, timeout=5000)
-                        page.fill(selector, username)
-                        print(f"[Lexoffice] Username entered with selector: {selector}")
-                        username_filled = True
-                        break
-                    except:
-                        continue
+                try:
+                    page.locator(USERNAME_SELECTOR).first.fill(username, timeout=remaining_ms())
+                    print("[Lexoffice] Username entered")
+                    username_filled = True
+                except PlaywrightTimeoutError:
+                    pass
 
                 if not username_filled:
                     print(f"[Lexoffice] Could not find username field")
@@ -147,16 +156,16 @@ def _run_playwright_in_thread(username, password, result_container):
                     raise Exception("Username field not found")
 
                 # Fill password
-                page.fill("input[type='password']", password)
+                page.fill("input[type='password']", password, timeout=remaining_ms())
                 print("[Lexoffice] Password entered")
 
                 # Click submit button
-                page.click("button[type='submit']")
+                page.click("button[type='submit']", timeout=remaining_ms())
                 print("[Lexoffice] Login form submitted")
 
-                # Wait for navigation
-                page.wait_for_load_state('networkidle', timeout=15000)
-                sleep(3)
+                # Logged in once lexoffice navigates away from the sign-in page
+                page.wait_for_url(lambda url: 'sign-in' not in url, timeout=remaining_ms())
+                page.wait_for_load_state('domcontentloaded', timeout=remaining_ms())
 
                 print(f"[Lexoffice] After login - URL: {page.url}")
                 print(f"[Lexoffice] After login - Title: {page.title()}")
@@ -179,6 +188,7 @@ def _run_playwright_in_thread(username, password, result_container):
             browser.close()
 
             result_container['cookies'] = cookies if cookies else None
+            result_container['cookie_jar'] = playwright_cookies
 
     except Exception as e:
         print(f"[Lexoffice] Error in Playwright thread: {e}")
@@ -186,131 +196,141 @@ def _run_playwright_in_thread(username, password, result_container):
         traceback.print_exc()
         result_container['cookies'] = None
 
-def solve_aws_waf_challenge(username, password):
+def solve_aws_waf_challenge(username, password, store=None):
     """
     Solves AWS WAF challenge using Playwright and extracts cookies.
     Returns a dict of cookies that can be used with requests.Session.
+    The cookies are saved to the SessionStore `store`, if given.
     """
-    global _waf_cookies
-
     if not PLAYWRIGHT_AVAILABLE:
         print("[Lexoffice] Cannot solve AWS WAF challenge - Playwright not installed")
         print("[Lexoffice] Install with: pip install playwright && playwright install chromium")
         return None
 
+    # The lock is held until the browser thread has finished, even if we stop waiting for it
+    _browser_lock.acquire()
     print("[Lexoffice] Solving AWS WAF challenge with Playwright...")
 
+    def run_browser():
+        try:
+            _run_playwright_in_thread(username, password, result_container)
+        finally:
+            _browser_lock.release()
+
     # Run Playwright in a separate thread to avoid asyncio conflicts
     result_container = {}
-    thread = threading.Thread(
-        target=_run_playwright_in_thread,
-        args=(username, password, result_container)
-    )
-    thread.start()
-    thread.join(timeout=60)  # 60 second timeout
+    with metrics.timed("lexoffice", "login") as call:
+        thread = threading.Thread(target=run_browser)
+        try:
+            thread.start()
+        except RuntimeError:
+            _browser_lock.release()
+            raise
+        # Every step stops at the deadline, closing the browser may take a moment longer
+        thread.join(timeout=LOGIN_TIMEOUT + BROWSER_CLOSE_GRACE)
+        if thread.is_alive() or not result_container.get('cookies'):
+            call.status = "error"
 
     if thread.is_alive():
-        print("[Lexoffice] Playwright thread timed out after 60 seconds")
+        print(f"[Lexoffice] Playwright thread timed out after {LOGIN_TIMEOUT} seconds")
         return None
 
     cookies = result_container.get('cookies')
-    if cookies:
-        _waf_cookies = cookies
+    if cookies and store:
+        store.save(result_container.get('cookie_jar'))
 
     return cookies
 
-def get_session(username=None, password=None):
-    global _session, _waf_cookies
-    if _session is None:
-        _session = requests.Session()
-        if username and password:
-            # Always use Playwright if available due to AWS WAF
-            if PLAYWRIGHT_AVAILABLE:
-                if _waf_cookies is None:
-                    print("[Lexoffice] Using Playwright to bypass AWS WAF protection...")
-                    _waf_cookies = solve_aws_waf_challenge(username, password)
-
-                if _waf_cookies:
-                    # Apply the cookies from browser session to requests session
-                    for name, value in _waf_cookies.items():
-                        _session.cookies.set(name, value)
-                    print("[Lexoffice] Successfully applied WAF cookies to session")
-                    return _session
-                else:
-                    print("[Lexoffice] Failed to solve AWS WAF challenge")
-                    _session = None
-                    return None
-
-            # Fallback for systems without Playwright (will likely fail with AWS WAF)
-            print("[Lexoffice] WARNING: Playwright not available, trying direct API login (may fail due to AWS WAF)")
-            url = urllib.parse.urljoin(
-                LEXOFFICE_BASE_URL,
-                'janus/janus-rest/public/login/web/v100/authenticate'
-            )
-            payload = {"username": username, "password": password}
-            response = _session.post(url, json=payload, headers=BROWSER_HEADERS)
-            print("Received cookies: ", response.cookies.get_dict())
-
-            if response.status_code == 401:
-                print("[Lexoffice] Auth failed. This could be due to:")
-                print("  1. AWS WAF blocking the request (install Playwright to bypass)")
-                print("  2. Invalid credentials")
-                print("[Lexoffice] Install dependencies: pip install playwright && playwright install chromium")
-                _session = None
-            elif response.status_code == 200 or response.status_code == 202:
-                # Success - session cookies should be set
-                print(f"[Lexoffice] Session created successfully (status {response.status_code})")
-            else:
-                print(f"[Lexoffice] Error creating session cookie: {response.status_code}")
-                print(f"[Lexoffice] Response: {response.text[:200]}")
-                _session = None
-    return _session
-
-def upload_voucher(filepath, username=None, password=None):
-    filename = os.path.basename(filepath)
-    print(f"[Lexoffice] Received filename {filename} to upload")
-
-    headers = {
-        'accept': '*/*',
-        'origin': LEXOFFICE_BASE_URL,
-        'user-agent': 'Mozilla/5.0 (X11; Linux x86_64) AppleWebKit/537.36',
-        'x-bookkeeping-voucher-client': 'Belegliste',
-    }
+UPLOAD_HEADERS = {
+    'accept': '*/*',
+    'origin': LEXOFFICE_BASE_URL,
+    'user-agent': 'Mozilla/5.0 (X11; Linux x86_64) AppleWebKit/537.36',
+    'x-bookkeeping-voucher-client': 'Belegliste',
+}
 
-    session = get_session(username, password)
-    url = urllib.parse.urljoin(
+def _voucher_url():
+    return urllib.parse.urljoin(
         LEXOFFICE_BASE_URL,
         'capsa/capsa-rest/v2/vouchers'
     )
 
-    def post_file(session):
-        with open(filepath, 'rb') as f:
-            files = [
-                ('datasource', (None, 'USER_BROWSER')),
-                ('documents', (filename, f, 'application/pdf')),
-            ]
-            sleep(0.5)
-            return session.post(url, headers=headers, files=files)
-
-    if not session:
-        print("[Lexoffice] Failed to create session, cannot upload document")
-        return None
+class _StreamBody:
+    """
+    File-like view of the chunks of a body of known length. requests sends it with a
+    Content-Length taken from `len()` and reads it piece by piece, instead of falling back
+    to chunked transfer encoding as it does for generators.
+    """
 
-    response = post_file(session)
+    def __init__(self, chunks, length):
+        self._chunks = iter(chunks)
+        self._buffer = b''
+        self._length = length
 
-    if response.status_code == 401 and username and password:
-        print("[Lexoffice] Returned unauthorized, attempting to refresh session...")
-        global _session, _waf_cookies
-        _session = None
-        _waf_cookies = None  # Clear WAF cookies to force re-authentication
-        session = get_session(username, password)
-        if session:
-            response = post_file(session)
-        else:
-            print("[Lexoffice] Failed to refresh session")
-            return None
+    def __len__(self):
+        return self._length
+
+    def read(self, size=-1):
+        while size < 0 or len(self._buffer) < size:
+            chunk = next(self._chunks, None)
+            if chunk is None:
+                break
+            self._buffer += chunk
+        if size < 0:
+            size = len(self._buffer)
+        data, self._buffer = self._buffer[:size], self._buffer[size:]
+        return data
 
-    # Handle response
+
+def _post_multipart(session, filename, chunks, size=None):
+    """
+    Streams a multipart/form-data voucher upload, reading the document from `chunks`.
+    With the document `size` known the body is sent with a Content-Length, otherwise chunked.
+    """
+    boundary = uuid.uuid4().hex
+    head = (
+        f'--{boundary}\r\n'
+        'Content-Disposition: form-data; name="datasource"\r\n\r\n'
+        'USER_BROWSER\r\n'
+        f'--{boundary}\r\n'
+        f'Content-Disposition: form-data; name="documents"; filename="{filename}"\r\n'
+        'Content-Type: application/pdf\r\n\r\n'
+    ).encode()
+    tail = f'\r\n--{boundary}--\r\n'.encode()
+
+    def body():
+        yield head
+        for chunk in chunks:
+            metrics.TRANSFERRED_BYTES.inc(len(chunk), service="lexoffice", direction="upload")
+            yield chunk
+        yield tail
+
+    headers = dict(UPLOAD_HEADERS)
+    headers['content-type'] = f'multipart/form-data; boundary={boundary}'
+    data = body() if size is None else _StreamBody(body(), len(head) + size + len(tail))
+    return session.post(_voucher_url(), headers=headers, data=data)
+
+
+def _batches(documents, batch_size, max_bytes):
+    """
+    Groups the indexes of the (filepath, filename) `documents` into batches of at most
+    `batch_size` documents and `max_bytes` bytes. Larger documents get a batch of their own.
+    File names are unique within a batch, the vouchers are mapped back by them.
+    """
+    batch, batch_bytes, filenames = [], 0, set()
+    for index, (filepath, filename) in enumerate(documents):
+        size = os.path.getsize(filepath)
+        if batch and (len(batch) >= batch_size or batch_bytes + size > max_bytes or filename in filenames):
+            yield batch
+            batch, batch_bytes, filenames = [], 0, set()
+        batch.append(index)
+        batch_bytes += size
+        filenames.add(filename)
+    if batch:
+        yield batch
+
+
+def _voucher_id(response):
+    """Returns the lexoffice UUID of a single uploaded voucher, or None if the upload failed."""
     if response.status_code == 200:
         try:
             lexoffice_document_uuid = response.json().get('id', None)
@@ -324,3 +344,378 @@ def upload_voucher(filepath, username=None, password=None):
         print(f"[Lexoffice] Request failed with status code: {response.status_code}")
         print(f"[Lexoffice] Response text: {response.text[:200]}")
         return None
+
+
+def _batch_voucher_ids(response, filenames):
+    """
+    Maps the vouchers created by a batched upload to the uploaded `filenames` by the file name
+    lexoffice reports for each voucher. Positions are not trusted, a wrong guess would link
+    documents to the vouchers of others.
+    Returns the UUIDs in the order of `filenames`, or None if the response cannot be mapped.
+    """
+    try:
+        vouchers = response.json()
+    except ValueError:
+        return None
+    if isinstance(vouchers, dict):
+        vouchers = vouchers.get('vouchers')
+    if not isinstance(vouchers, list) or len(vouchers) != len(filenames):
+        return None
+
+    vouchers = [voucher if isinstance(voucher, dict) else {'id': voucher} for voucher in vouchers]
+    if not all(voucher.get('id') for voucher in vouchers):
+        return None
+    by_name = {
+        voucher.get('fileName') or voucher.get('filename'): voucher['id']
+        for voucher in vouchers
+    }
+    if len(by_name) != len(vouchers) or set(by_name) != set(filenames):
+        return None
+    return [by_name[filename] for filename in filenames]
+
+
+class LexofficeClient:
+    """
+    One lexoffice account: its login session (optionally persisted in `session_store`),
+    the adaptive rate limiter pacing its uploads and the circuit breaker tracking whether
+    it currently accepts uploads. Upload workers share the client across threads.
+    """
+
+    def __init__(self, username=None, password=None, session_store=None):
+        self.username = username
+        self.password = password
+        self.session_store = session_store or SessionStore()
+        self.upload_limiter = AdaptiveRateLimiter()
+        self.upload_breaker = CircuitBreaker("lexoffice")  # callers check it before preparing an upload
+        self.batch_uploads = True  # cleared once lexoffice rejects a batched upload
+        self._session = None
+        self._waf_cookies = None
+        self._session_lock = threading.Lock()  # upload workers share one session, only one of them may log in
+
+    def get_session(self):
+        with self._session_lock:
+            return self._get_session()
+
+    def prewarm(self):
+        """
+        Logs in on a background thread, so the login overlaps with listing and downloading
+        the first documents. Uploads that come earlier wait for it instead of logging in again.
+        """
+        if not (PREWARM_LOGIN and self.username and self.password):
+            return
+        print("[Lexoffice] Logging in in the background...")
+        threading.Thread(target=self.get_session, name="lexoffice-login", daemon=True).start()
+
+    def invalidate_session(self, session):
+        """Drops the given session, unless another worker already replaced it with a fresh one."""
+        with self._session_lock:
+            if self._session is session:
+                self._session = None
+                self._waf_cookies = None  # Clear WAF cookies to force re-authentication
+                self.session_store.clear()
+
+    def _load_stored_session(self):
+        """
+        Returns the cookies of a session stored by an earlier run if lexoffice still accepts
+        them, checked with a single authenticated request. Returns None otherwise.
+        """
+        cookies = self.session_store.load()
+        if not cookies:
+            return None
+
+        url = urllib.parse.urljoin(LEXOFFICE_BASE_URL, SESSION_CHECK_PATH)
+        try:
+            with metrics.timed("lexoffice", "session_check") as call:
+                # A dead session is redirected to the sign-in page, which would answer 200
+                response = requests.get(
+                    url, cookies=cookies, headers=UPLOAD_HEADERS, timeout=DEFAULT_TIMEOUT, allow_redirects=False
+                )
+                call.status = response.status_code
+        except requests.RequestException as e:
+            print(f"[Lexoffice] Could not check stored session: {e}")
+            return None
+
+        if response.status_code in (401, 403) or 300 <= response.status_code < 400:
+            print(f"[Lexoffice] Stored session rejected with status {response.status_code}")
+            self.session_store.clear()
+            return None
+        if not 200 <= response.status_code < 300:
+            # Says nothing about the session, it is kept for the next check
+            print(f"[Lexoffice] Could not check stored session, status {response.status_code}")
+            return None
+
+        print("[Lexoffice] Stored session is still valid")
+        return cookies
+
+    def _get_session(self):
+        username, password = self.username, self.password
+        if self._session is None:
+            self._session = requests.Session()
+            if username and password:
+                stored_cookies = self._load_stored_session() if self._waf_cookies is None else None
+                if stored_cookies:
+                    self._waf_cookies = stored_cookies
+                    for name, value in self._waf_cookies.items():
+                        self._session.cookies.set(name, value)
+                    print("[Lexoffice] Reusing stored session, skipping browser login")
+                    metrics.LOGINS.inc(method="stored_session")
+                    return self._session
+
+                # Always use Playwright if available due to AWS WAF
+                if PLAYWRIGHT_AVAILABLE:
+                    if self._waf_cookies is None:
+                        print("[Lexoffice] Using Playwright to bypass AWS WAF protection...")
+                        self._waf_cookies = solve_aws_waf_challenge(username, password, store=self.session_store)
+
+                    if self._waf_cookies:
+                        # Apply the cookies from browser session to requests session
+                        for name, value in self._waf_cookies.items():
+                            self._session.cookies.set(name, value)
+                        print("[Lexoffice] Successfully applied WAF cookies to session")
+                        metrics.LOGINS.inc(method="browser")
+                        return self._session
+                    else:
+                        print("[Lexoffice] Failed to solve AWS WAF challenge")
+                        self._session = None
+                        return None
+
+                # Fallback for systems without Playwright (will likely fail with AWS WAF)
+                print("[Lexoffice] WARNING: Playwright not available, trying direct API login (may fail due to AWS WAF)")
+                url = urllib.parse.urljoin(
+                    LEXOFFICE_BASE_URL,
+                    'janus/janus-rest/public/login/web/v100/authenticate'
+                )
+                payload = {"username": username, "password": password}
+                with metrics.timed("lexoffice", "login") as call:
+                    response = self._session.post(url, json=payload, headers=BROWSER_HEADERS)
+                    call.status = response.status_code
+                print("Received cookies: ", response.cookies.get_dict())
+
+                if response.status_code == 401:
+                    print("[Lexoffice] Auth failed. This could be due to:")
+                    print("  1. AWS WAF blocking the request (install Playwright to bypass)")
+                    print("  2. Invalid credentials")
+                    print("[Lexoffice] Install dependencies: pip install playwright && playwright install chromium")
+                    self._session = None
+                elif response.status_code == 200 or response.status_code == 202:
+                    # Success - session cookies should be set
+                    print(f"[Lexoffice] Session created successfully (status {response.status_code})")
+                    metrics.LOGINS.inc(method="direct")
+                    self.session_store.save([
+                        {"name": c.name, "value": c.value, "expires": c.expires or -1}
+                        for c in self._session.cookies
+                    ])
+                else:
+                    print(f"[Lexoffice] Error creating session cookie: {response.status_code}")
+                    print(f"[Lexoffice] Response: {response.text[:200]}")
+                    self._session = None
+        return self._session
+
+    def upload_voucher(self, filepath, filename=None):
+        """Uploads the file at `filepath`, named `filename` in lexoffice (its file name by default)."""
+        filename = filename or os.path.basename(filepath)
+        print(f"[Lexoffice] Received filename {filename} to upload")
+
+        def post_file(session):
+            with open(filepath, 'rb') as f:
+                files = [
+                    ('datasource', (None, 'USER_BROWSER')),
+                    ('documents', (filename, f, 'application/pdf')),
+                ]
+                response = session.post(_voucher_url(), headers=UPLOAD_HEADERS, files=files)
+            metrics.TRANSFERRED_BYTES.inc(os.path.getsize(filepath), service="lexoffice", direction="upload")
+            return response
+
+        return self._send_voucher(post_file, post_file)
+
+    def upload_vouchers(self, documents, batch_size=UPLOAD_BATCH_SIZE, max_bytes=UPLOAD_BATCH_MAX_BYTES):
+        """
+        Uploads the (filepath, filename) `documents`, several of them per request: they are grouped
+        into batches of at most `batch_size` documents and `max_bytes` bytes, each sent as one
+        multipart request with a `documents` part per file. If lexoffice rejects a batch (4xx), the
+        batch is uploaded one by one instead and later calls no longer batch. A batch lexoffice
+        accepted but whose vouchers cannot be mapped back to the files counts as failed, uploading
+        it again could duplicate the vouchers.
+        Returns the lexoffice UUID (or None) of every document, in the order of `documents`.
+        """
+        voucher_ids = [None] * len(documents)
+        for batch in _batches(documents, batch_size, max_bytes):
+            if len(batch) > 1 and self.batch_uploads:
+                batch_ids = self._upload_batch([documents[index] for index in batch])
+                if batch_ids is not None:
+                    for index, voucher_id in zip(batch, batch_ids):
+                        voucher_ids[index] = voucher_id
+                    continue
+                print(f"[Lexoffice] Uploading the {len(batch)} documents of the rejected batch one by one...")
+            for index in batch:
+                filepath, filename = documents[index]
+                voucher_ids[index] = self.upload_voucher(filepath, filename=filename)
+        return voucher_ids
+
+    def _upload_batch(self, documents):
+        """
+        Uploads the (filepath, filename) `documents` in a single request. Returns their UUIDs,
+        None for every document if the upload failed, or None if lexoffice rejected the batch (4xx).
+        """
+        filenames = [filename for _, filename in documents]
+        print(f"[Lexoffice] Received batch of {len(documents)} documents to upload: {', '.join(filenames)}")
+
+        def post_batch(session):
+            with contextlib.ExitStack() as stack:
+                files = [('datasource', (None, 'USER_BROWSER'))] + [
+                    ('documents', (filename, stack.enter_context(open(filepath, 'rb')), 'application/pdf'))
+                    for filepath, filename in documents
+                ]
+                response = session.post(_voucher_url(), headers=UPLOAD_HEADERS, files=files)
+            metrics.TRANSFERRED_BYTES.inc(
+                sum(os.path.getsize(filepath) for filepath, _ in documents), service="lexoffice", direction="upload"
+            )
+            return response
+
+        def parse(response):
+            status = response.status_code
+            if 200 <= status < 300:
+                voucher_ids = _batch_voucher_ids(response, filenames)
+                if voucher_ids is not None:
+                    print(f"[Lexoffice] Batch of {len(documents)} documents uploaded successfully, "
+                          f"has lexoffice UUIDs {', '.join(map(str, voucher_ids))}")
+                    return voucher_ids
+                # Accepted, so uploading the documents again could duplicate vouchers (or a combined one)
+                print(f"[Lexoffice] Could not map the response to a batched upload to its documents, "
+                      f"check lexoffice for their vouchers: {response.text}")
+                print("[Lexoffice] Uploading documents one by one from now on.")
+                self.batch_uploads = False
+                return [None] * len(documents)
+            if not 400 <= status < 500 or status == 401 or status in THROTTLE_STATUS_CODES:
+                # Not a verdict on batching, the documents are retried in the next cycle
+                print(f"[Lexoffice] Batched upload failed with status code: {status}")
+                return [None] * len(documents)
+            print(f"[Lexoffice] Batched upload rejected with status code {status}: {response.text[:200]}")
+            print("[Lexoffice] Uploading documents one by one from now on.")
+            self.batch_uploads = False
+            return None
+
+        voucher_ids = self._send_voucher(post_batch, post_batch, parse=parse)
+        if voucher_ids is None and self.batch_uploads:
+            return [None] * len(documents)  # no session
+        return voucher_ids
+
+    def upload_voucher_stream(self, chunks, filename, reopen, size=None):
+        """
+        Uploads a document whose content is produced chunk by chunk by `chunks`, without
+        ever holding the whole file in memory or writing it to disk.
+        A stream can only be sent once: if the upload has to be retried, `reopen` is called
+        for a fresh iterable of chunks, which is spooled to a temporary file (kept in memory
+        up to SPOOL_MAX_SIZE bytes) so further attempts can re-read it.
+        `size` is the content length if known, otherwise the body is sent chunked.
+        """
+        print(f"[Lexoffice] Received stream {filename} to upload")
+        spool = None
+
+        def post_stream(session):
+            return _post_multipart(session, filename, chunks, size)
+
+        def post_spooled(session):
+            nonlocal spool
+            if spool is None:
+                fresh_chunks = reopen()
+                if fresh_chunks is None:
+                    raise IOError(f"Could not reopen {filename} for retrying the upload")
+                spool = tempfile.SpooledTemporaryFile(max_size=SPOOL_MAX_SIZE)
+                for chunk in fresh_chunks:
+                    spool.write(chunk)
+            spooled_size = spool.seek(0, os.SEEK_END)
+            spool.seek(0)
+            return _post_multipart(session, filename, iter(lambda: spool.read(CHUNK_SIZE), b''), spooled_size)
+
+        try:
+            return self._send_voucher(post_stream, post_spooled)
+        finally:
+            if spool is not None:
+                spool.close()
+
+    def _send_voucher(self, post, retry_post, parse=None):
+        """
+        Sends a voucher upload with `post(session)`, paced by the upload rate limiter.
+        Throttled uploads (429/503) are repeated once lexoffice allows, and the session is refreshed
+        once on 401; repeated uploads are sent with `retry_post(session)`.
+        The outcome is reported to the upload circuit breaker.
+        Returns the final response passed through `parse`, by default the lexoffice UUID or None.
+        """
+        session = self.get_session()
+        if not session:
+            print("[Lexoffice] Failed to create session, cannot upload document")
+            self.upload_breaker.record_failure()
+            return None
+
+        try:
+            response = self._send_paced(session, post, retry_post)
+        except requests.RequestException:
+            self.upload_breaker.record_failure()
+            raise
+        if response is None:
+            self.upload_breaker.record_failure()
+            return None
+
+        # Errors caused by the document itself say nothing about the health of lexoffice
+        status = response.status_code
+        if status == 401 or status in THROTTLE_STATUS_CODES or status >= 500:
+            self.upload_breaker.record_failure()
+        else:
+            self.upload_breaker.record_success()
+
+        return (parse or _voucher_id)(response)
+
+    def _send_paced(self, session, post, retry_post):
+        """Runs the attempts of `_send_voucher`, returns the final response or None if the session was lost."""
+        send = post
+        refreshed = False
+        for _ in range(THROTTLE_RETRIES + 1):
+            self.upload_limiter.acquire()
+            started = time.monotonic()
+            with metrics.timed("lexoffice", "upload") as call:
+                response = send(session)
+                call.status = response.status_code
+            send = retry_post
+
+            if response.status_code in THROTTLE_STATUS_CODES:
+                delay = self.upload_limiter.throttled(parse_retry_after(response.headers.get('Retry-After')), sent_at=started)
+                print(f"[Lexoffice] Throttled with status {response.status_code}, retrying in {delay:.1f} seconds (rate now {self.upload_limiter.rate:.2f}/s)...")
+                continue
+            self.upload_limiter.succeeded(time.monotonic() - started)
+
+            if response.status_code == 401 and self.username and self.password and not refreshed:
+                print("[Lexoffice] Returned unauthorized, attempting to refresh session...")
+                metrics.AUTH_REFRESHES.inc()
+                refreshed = True
+                self.invalidate_session(session)
+                session = self.get_session()
+                if not session:
+                    print("[Lexoffice] Failed to refresh session")
+                    return None
+                continue
+            break
+        return response
+
+
+def get_client(username=None, password=None, session_store=None):
+    """Returns the shared client for the given lexoffice account, creating it on first use."""
+    with _clients_lock:
+        if username not in _clients:
+            _clients[username] = LexofficeClient(username, password, session_store=session_store)
+        return _clients[username]
+
+def get_session(username=None, password=None):
+    return get_client(username, password).get_session()
+
+def invalidate_session(session, username=None):
+    get_client(username).invalidate_session(session)
+
+def upload_voucher(filepath, username=None, password=None, filename=None):
+    return get_client(username, password).upload_voucher(filepath, filename=filename)
+
+def upload_vouchers(documents, username=None, password=None):
+    return get_client(username, password).upload_vouchers(documents)
+
+def upload_voucher_stream(chunks, filename, reopen, size=None, username=None, password=None):
+    return get_client(username, password).upload_voucher_stream(chunks, filename, reopen, size=size)
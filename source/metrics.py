@@ -0,0 +1,219 @@
+import os
+import time
+import asyncio
+import threading
+from contextlib import contextmanager
+
+METRICS_ENABLED = os.getenv("METRICS_ENABLED", "false").lower() == "true"
+METRICS_HOST = os.getenv("METRICS_HOST", "0.0.0.0")
+METRICS_PORT = int(os.getenv("METRICS_PORT", 9100))
+METRICS_PATH = "/metrics"
+
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)  # seconds
+
+_registry = []
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_labels(names, values, extra=()):
+    pairs = [f'{name}="{_escape(value)}"' for name, value in list(zip(names, values)) + list(extra)]
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+class _Metric:
+    kind = None
+
+    def __init__(self, name, documentation, labels=()):
+        self.name = name
+        self.documentation = documentation
+        self.labels = tuple(labels)
+        self._values = {}
+        self._lock = threading.Lock()
+        _registry.append(self)
+
+    def _key(self, labels):
+        return tuple(str(labels.get(name, "")) for name in self.labels)
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+        with self._lock:
+            for key, value in sorted(self._values.items()):
+                lines.extend(self._render_value(key, value))
+        return lines
+
+    def _render_value(self, key, value):
+        return [f"{self.name}{_format_labels(self.labels, key)} {value}"]
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+
+class Gauge(_Metric):
+    kind = "gauge"
+
+    def set(self, value, **labels):
+        with self._lock:
+            self._values[self._key(labels)] = value
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, name, documentation, labels=(), buckets=LATENCY_BUCKETS):
+        super().__init__(name, documentation, labels)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            counts, total, count = self._values.get(key, ([0] * len(self.buckets), 0.0, 0))
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[i] += 1
+            self._values[key] = (counts, total + value, count + 1)
+
+    def _render_value(self, key, value):
+        counts, total, count = value
+        lines = [
+            f"{self.name}_bucket{_format_labels(self.labels, key, [('le', bound)])} {bucket_count}"
+            for bound, bucket_count in zip(self.buckets, counts)
+        ]
+        lines.append(f"{self.name}_bucket{_format_labels(self.labels, key, [('le', '+Inf')])} {count}")
+        lines.append(f"{self.name}_sum{_format_labels(self.labels, key)} {total}")
+        lines.append(f"{self.name}_count{_format_labels(self.labels, key)} {count}")
+        return lines
+
+
+REQUEST_DURATION = Histogram(
+    "paperless_lexoffice_request_duration_seconds",
+    "Duration of the requests sent to paperless-ngx and lexoffice",
+    ("service", "operation"),
+)
+REQUEST_FAILURES = Counter(
+    "paperless_lexoffice_request_failures_total",
+    "Failed requests to paperless-ngx and lexoffice by HTTP status, `error` if no usable response came back",
+    ("service", "operation", "status"),
+)
+TRANSFERRED_BYTES = Counter(
+    "paperless_lexoffice_transferred_bytes_total",
+    "Document bytes downloaded from paperless-ngx and uploaded to lexoffice",
+    ("service", "direction"),
+)
+LOGINS = Counter(
+    "paperless_lexoffice_logins_total",
+    "lexoffice sessions established, by how they were obtained",
+    ("method",),
+)
+AUTH_REFRESHES = Counter(
+    "paperless_lexoffice_auth_refreshes_total",
+    "lexoffice sessions refreshed after an upload was answered with 401",
+)
+COMPRESSION_SAVED_BYTES = Counter(
+    "paperless_lexoffice_compression_saved_bytes_total",
+    "Bytes saved by compressing documents before the upload",
+    ("tenant",),
+)
+STAGE_DURATION = Histogram(
+    "paperless_lexoffice_stage_duration_seconds",
+    "Time a document spends in each sync stage",
+    ("tenant", "stage"),
+)
+QUEUE_DEPTH = Gauge(
+    "paperless_lexoffice_queue_depth",
+    "Documents waiting in front of each sync stage",
+    ("tenant", "stage"),
+)
+DOCUMENTS = Counter(
+    "paperless_lexoffice_documents_total",
+    "Documents leaving the sync, by result",
+    ("tenant", "result"),
+)
+CYCLE_DOCUMENTS = Gauge(
+    "paperless_lexoffice_cycle_documents",
+    "Documents fed into the pipeline in the last sync cycle",
+    ("tenant",),
+)
+CYCLE_DURATION = Histogram(
+    "paperless_lexoffice_cycle_duration_seconds",
+    "Duration of the sync cycles",
+    ("tenant",),
+)
+
+
+class _Call:
+    status = None
+
+
+@contextmanager
+def timed(service, operation):
+    """
+    Measures a request to `service`. Callers set the `status` of the yielded call to the HTTP
+    status they got, statuses >= 400 and exceptions are counted as failures.
+    """
+    call = _Call()
+    started = time.monotonic()
+    try:
+        yield call
+    except Exception:
+        call.status = "error"
+        raise
+    finally:
+        REQUEST_DURATION.observe(time.monotonic() - started, service=service, operation=operation)
+        if call.status == "error" or (call.status or 0) >= 400:
+            REQUEST_FAILURES.inc(service=service, operation=operation, status=call.status)
+
+
+def render():
+    lines = []
+    for metric in _registry:
+        lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
+
+
+class MetricsServer:
+    """Serves the metrics in the Prometheus text format on METRICS_PATH."""
+
+    def __init__(self, host=METRICS_HOST, port=METRICS_PORT):
+        self.host = host
+        self.port = port
+        self._server = None
+
+    async def start(self):
+        self._server = await asyncio.start_server(self._handle, self.host, self.port)
+        print(f"[Metrics] Serving metrics on {self.host}:{self.port}{METRICS_PATH}")
+
+    async def stop(self):
+        if self._server:
+            self._server.close()
+            await self._server.wait_closed()
+
+    async def _handle(self, reader, writer):
+        try:
+            request_line = (await reader.readline()).decode("latin-1").split()
+            while (await reader.readline()) not in (b"\r\n", b"\n", b""):
+                pass
+
+            if len(request_line) >= 2 and request_line[0] == "GET" and request_line[1].split("?")[0] == METRICS_PATH:
+                status, body = "200 OK", render().encode()
+            else:
+                status, body = "404 Not Found", b"Not Found\n"
+            writer.write(
+                f"HTTP/1.1 {status}\r\n"
+                "Content-Type: text/plain; version=0.0.4\r\n"
+                f"Content-Length: {len(body)}\r\n"
+                "Connection: close\r\n\r\n".encode() + body
+            )
+            await writer.drain()
+        except (ConnectionError, ValueError) as e:
+            print(f"[Metrics] Error handling request: {e}")
+        finally:
+            writer.close()
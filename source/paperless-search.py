@@ -1,84 +1,113 @@
 import os
+import sys
 import asyncio
-import paperless
-import lexoffice
+import argparse
+import webhook
+import metrics
+from sync import TenantSync
+from backfill import Backfill, BACKFILL_CONCURRENCY
+from tenants import TENANTS_FILE, load_tenants, tenant_from_env
 
 # Config
-POLLING_INTERVAL = int(os.getenv("POLLING_INTERVAL", 60))
-PAPERLESS_TOKEN = os.getenv('PAPERLESS_TOKEN')
-PAPERLESS_URL = os.getenv('PAPERLESS_URL')
-INBOX_TAG_ID = os.getenv('INBOX_TAG_ID')
-LEXOFFICE_TAG_ID = os.getenv('LEXOFFICE_TAG_ID')
-LEXOFFICE_USERNAME = os.getenv('LEXOFFICE_USERNAME')
-LEXOFFICE_PASSWORD = os.getenv('LEXOFFICE_PASSWORD')
-CUSTOM_FIELD_ID_PREVIEW_URL = os.getenv('CUSTOM_FIELD_ID_PREVIEW_URL')
-
-TMP_DIR = "tmp"
-LOCK_FILE = 'script.lock'
-
-LEXOFFICE_VOUCHER_PREVIEW_URL = "https://app.lexware.de/vouchers#!/VoucherList//PurchaseInvoice/"
-
-def create_lock():
-    with open(LOCK_FILE, 'w') as f:
-        f.write(str(os.getpid()))
-
-def remove_lock():
-    if os.path.exists(LOCK_FILE):
-        os.remove(LOCK_FILE)
-
-def is_locked():
-    return os.path.exists(LOCK_FILE)
-
-async def sync_paperless_to_lexoffice():
-    if is_locked():
-        print("[Sync] Script is already running. Exiting.")
-        return
-
-    create_lock()
-    try:
-        print("[Sync] Checking for new documents in paperless-ngx tagged for upload...")
-        document_ids = paperless.filter_documents_by_tags(
-            PAPERLESS_TOKEN, PAPERLESS_URL, [INBOX_TAG_ID, LEXOFFICE_TAG_ID]
+WEBHOOK_ENABLED = os.getenv("WEBHOOK_ENABLED", "false").lower() == "true"
+SAFETY_POLLING_INTERVAL = int(os.getenv("SAFETY_POLLING_INTERVAL", 3600))
+
+async def periodic_main(syncs):
+    await asyncio.gather(*(sync.run_periodic() for sync in syncs))
+
+async def webhook_main(syncs, safety_interval_seconds, multi_tenant):
+    """
+    Serves the webhooks of all tenants from a single endpoint. With several tenants every
+    tenant gets its own path below WEBHOOK_PATH, e.g. /webhook/<tenant name>.
+    """
+    receiver = webhook.WebhookReceiver()
+    channels = [
+        receiver.channel(
+            f"{webhook.WEBHOOK_PATH}/{sync.tenant.name}" if multi_tenant else webhook.WEBHOOK_PATH,
+            sync.tenant.webhook_token,
         )
-
-        if document_ids:
-            os.makedirs(TMP_DIR, exist_ok=True)
-            for doc_id in document_ids:
-                file_content = paperless.download_document(PAPERLESS_TOKEN, PAPERLESS_URL, doc_id)
-                filepath = os.path.join(TMP_DIR, f"{doc_id}.pdf")
-                with open(filepath, "wb") as file:
-                    file.write(file_content)
-
-                lexoffice_document_uuid = lexoffice.upload_voucher(
-                    filepath,
-                    username=LEXOFFICE_USERNAME,
-                    password=LEXOFFICE_PASSWORD
-                )
-
-                os.remove(filepath)
-
-                if lexoffice_document_uuid:
-                    print("[Sync] Upload successful. Deleting file from tmp...")
-                    paperless.remove_tag(PAPERLESS_TOKEN, PAPERLESS_URL, doc_id, [LEXOFFICE_TAG_ID])
-
-                    if CUSTOM_FIELD_ID_PREVIEW_URL:
-                        print("[Sync] Adding voucher preview URL as custom field...")
-                        paperless.set_custom_field(PAPERLESS_TOKEN, PAPERLESS_URL, doc_id, CUSTOM_FIELD_ID_PREVIEW_URL, f"{LEXOFFICE_VOUCHER_PREVIEW_URL}{lexoffice_document_uuid}?filter=unchecked&sort=sortByLastModifiedDate&sortDirection=desc")
-                else:
-                    print(f"[Sync] Upload not successful. Deleting file from tmp as it gets downloaded in the next cycle.")
-
-    except Exception as e:
-        print(f"[Sync] An error occurred: {e}")
+        for sync in syncs
+    ]
+    await receiver.start()
+    try:
+        await asyncio.gather(*(
+            sync.run_webhook(channel, safety_interval_seconds) for sync, channel in zip(syncs, channels)
+        ))
     finally:
-        remove_lock()
+        await receiver.stop()
 
-async def periodic_main(interval_seconds):
-    while True:
-        await sync_paperless_to_lexoffice()
-        await asyncio.sleep(interval_seconds)
+async def run(syncs, multi_tenant):
+    server = metrics.MetricsServer() if metrics.METRICS_ENABLED else None
+    if server:
+        await server.start()
+    try:
+        if WEBHOOK_ENABLED:
+            await webhook_main(syncs, SAFETY_POLLING_INTERVAL, multi_tenant)
+        else:
+            await periodic_main(syncs)
+    finally:
+        if server:
+            await server.stop()
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Syncs documents from paperless-ngx to lexoffice.")
+    commands = parser.add_subparsers(dest="command")
+    backfill = commands.add_parser(
+        "backfill",
+        help="sync historical documents once, selected by query, tags or creation date",
+        description="Syncs all documents matching the selection once, whether or not they carry the "
+                    "lexoffice tag. Progress is checkpointed, rerunning the same selection resumes it.",
+    )
+    backfill.add_argument("--query", help="paperless full text query, e.g. 'correspondent:acme'")
+    backfill.add_argument("--tag", type=int, action="append", default=[], dest="tags",
+                          help="ID of a tag the documents must carry, repeatable")
+    backfill.add_argument("--created-after", help="only documents created on or after this date (YYYY-MM-DD)")
+    backfill.add_argument("--created-before", help="only documents created on or before this date (YYYY-MM-DD)")
+    backfill.add_argument("--concurrency", type=int, default=BACKFILL_CONCURRENCY,
+                          help="documents downloaded and uploaded in parallel")
+    backfill.add_argument("--checkpoint", help="progress file, defaults to backfill.json in the data directory")
+    backfill.add_argument("--tenant", help="name of the tenant to backfill, required with TENANTS_FILE")
+    args = parser.parse_args()
+    if args.command == "backfill" and not (args.query or args.tags or args.created_after or args.created_before):
+        parser.error("backfill needs at least one of --query, --tag, --created-after and --created-before")
+    return args
+
+def backfill_main(args, tenants):
+    if args.tenant:
+        tenants = [tenant for tenant in tenants if tenant.name == args.tenant]
+        if not tenants:
+            print(f"[Backfill] Unknown tenant {args.tenant}")
+            return 2
+    elif len(tenants) > 1:
+        print("[Backfill] Several tenants are configured, choose one with --tenant")
+        return 2
+
+    sync = TenantSync(tenants[0])
+    sync.lexoffice.prewarm()
+    backfill = Backfill(
+        sync, query=args.query, tags=args.tags, created_after=args.created_after,
+        created_before=args.created_before, checkpoint_path=args.checkpoint, concurrency=args.concurrency,
+    )
+    try:
+        return 0 if asyncio.run(backfill.run()) else 1
+    except KeyboardInterrupt:
+        print(f"[Backfill] Interrupted, run the same command again to resume from {backfill.checkpoint.path}")
+        return 130
 
 def main():
-    asyncio.run(periodic_main(POLLING_INTERVAL))
+    args = parse_args()
+    multi_tenant = bool(TENANTS_FILE)
+    tenants = load_tenants(TENANTS_FILE) if multi_tenant else [tenant_from_env()]
+    if args.command == "backfill":
+        return backfill_main(args, tenants)
+    if multi_tenant:
+        print(f"[Sync] Syncing {len(tenants)} tenants: {', '.join(tenant.name for tenant in tenants)}")
+    syncs = [TenantSync(tenant, isolated=multi_tenant) for tenant in tenants]
+    # The browser login takes a while, it runs while the first cycle lists and downloads documents
+    for sync in syncs:
+        sync.lexoffice.prewarm()
+
+    asyncio.run(run(syncs, multi_tenant))
 
 if __name__ == "__main__":
-    main()
+    sys.exit(main())
@@ -2,9 +2,25 @@ import os
 import requests
 import json
 import urllib
+import threading
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+import metrics
 
 
 DEFAULT_TIMEOUT = int(os.getenv("DEFAULT_TIMEOUT", 10))  # seconds
+PAGE_SIZE = int(os.getenv("PAPERLESS_PAGE_SIZE", 100))  # documents per listing page
+CHUNK_SIZE = int(os.getenv("STREAM_CHUNK_SIZE", 65536))  # bytes
+POOL_SIZE = int(os.getenv("PAPERLESS_POOL_SIZE", 10))  # kept-alive connections
+MAX_RETRIES = int(os.getenv("PAPERLESS_MAX_RETRIES", 3))
+RETRY_BACKOFF = float(os.getenv("PAPERLESS_RETRY_BACKOFF", 0.5))  # seconds, doubled on every retry
+
+RETRY_STATUS_CODES = (500, 502, 503, 504)
+# The listing only asks for what the sync needs, leaving out e.g. the OCR content of every document
+LISTING_FIELDS = ("id", "tags", "modified", "checksum", "original_file_name")
+
+_clients = {}
+_clients_lock = threading.Lock()
 
 def safe_json(response):
     """Try parsing JSON, else log error and return {}"""
@@ -15,118 +31,310 @@ def safe_json(response):
         return {}
 
 
-def search_documents(access_token, base_url, search_string):
-    url = urllib.parse.urljoin(base_url, f"api/documents/?query=({search_string})")
-    headers = {
-        "Authorization": f"Token {access_token}",
-        "Accept": "application/json",
-    }
+class PaperlessClient:
+    """
+    Talks to one paperless-ngx instance over a pooled keep-alive session, so consecutive
+    requests reuse warm connections instead of opening a new one each time.
+    Connection errors and transient 5xx responses are retried with exponential backoff.
+    """
 
-    try:
-        response = requests.get(url, headers=headers, timeout=DEFAULT_TIMEOUT)
-        if response.status_code != 200:
-            print(f"[Paperless] Search HTTP {response.status_code}: {response.text[:200]}")
-            return []
+    def __init__(self, access_token, base_url, pool_size=POOL_SIZE, max_retries=MAX_RETRIES,
+                 backoff_factor=RETRY_BACKOFF, timeout=DEFAULT_TIMEOUT):
+        self.base_url = base_url
+        self.timeout = timeout
 
-        search_data = safe_json(response)
-        document_ids = [doc.get("id") for doc in search_data.get("results", [])]
-        print(f"[Paperless] Search results: {document_ids}")
-        return document_ids
+        retry = Retry(
+            total=max_retries,
+            backoff_factor=backoff_factor,
+            status_forcelist=RETRY_STATUS_CODES,
+            allowed_methods=frozenset({"GET", "PATCH", "POST"}),  # all calls made here are idempotent, including bulk edits
+            raise_on_status=False,
+        )
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size, max_retries=retry)
 
-    except requests.RequestException as e:
-        print(f"[Paperless] Search connection error: {e}")
-        return []
+        self.session = requests.Session()
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        self.session.headers.update({
+            "Authorization": f"Token {access_token}",
+            "Accept": "application/json",
+        })
 
+    def close(self):
+        self.session.close()
 
-def filter_documents_by_tags(access_token, base_url, tags):
-    tags_string = ",".join(str(tag) for tag in tags)
-    url = urllib.parse.urljoin(base_url, f"api/documents/?tags__id__all={tags_string}")
-    headers = {
-        "Authorization": f"Token {access_token}",
-        "Accept": "application/json",
-    }
+    def search_documents(self, search_string):
+        url = urllib.parse.urljoin(self.base_url, f"api/documents/?query=({search_string})")
 
-    try:
-        response = requests.get(url, headers=headers, timeout=DEFAULT_TIMEOUT)
-        if response.status_code != 200:
-            print(f"[Paperless] Filter HTTP {response.status_code}: {response.text[:200]}")
+        try:
+            with metrics.timed("paperless", "search") as call:
+                response = self.session.get(url, timeout=self.timeout)
+                call.status = response.status_code
+            if response.status_code != 200:
+                print(f"[Paperless] Search HTTP {response.status_code}: {response.text[:200]}")
+                return []
+
+            search_data = safe_json(response)
+            document_ids = [doc.get("id") for doc in search_data.get("results", [])]
+            print(f"[Paperless] Search results: {document_ids}")
+            return document_ids
+
+        except requests.RequestException as e:
+            print(f"[Paperless] Search connection error: {e}")
             return []
 
-        search_data = safe_json(response)
-        document_ids = [doc.get("id") for doc in search_data.get("results", [])]
-        print(f"[Paperless] Filter results: {document_ids}")
-        return document_ids
+    def list_documents(self, tags, page_size=PAGE_SIZE, document_ids=None, modified_after=None, ordering=None,
+                       fields=LISTING_FIELDS, query=None, created_after=None, created_before=None):
+        """
+        Yields all documents carrying every tag in `tags`, as returned by the API, with only the
+        given `fields` (all fields if None).
+        The listing can be restricted to `document_ids`, to documents modified at or after
+        the ISO timestamp `modified_after`, to those matching the full text `query` and to those
+        created within the ISO dates `created_after` and `created_before` (both inclusive),
+        and sorted by the `ordering` fields.
+        Follows the `next` link of paperless' paginated response, one page at a time,
+        so callers can start processing the first documents while later pages are still pending.
+        """
+        params = {"page_size": page_size}
+        if tags:
+            params["tags__id__all"] = ",".join(str(tag) for tag in tags)
+        if document_ids:
+            params["id__in"] = ",".join(str(document_id) for document_id in sorted(document_ids))
+        if modified_after:
+            params["modified__gte"] = modified_after
+        if ordering:
+            params["ordering"] = ordering
+        if fields:
+            params["fields"] = ",".join(fields)
+        if query:
+            params["query"] = query
+        if created_after:
+            params["created__date__gte"] = created_after
+        if created_before:
+            params["created__date__lte"] = created_before
+        url = urllib.parse.urljoin(self.base_url, "api/documents/?" + urllib.parse.urlencode(params, safe=","))
 
-    except requests.RequestException as e:
-        print(f"[Paperless] Filter connection error: {e}")
-        return []
+        while url:
+            try:
+                with metrics.timed("paperless", "list") as call:
+                    response = self.session.get(url, timeout=self.timeout)
+                    call.status = response.status_code
+            except requests.RequestException as e:
+                print(f"[Paperless] Filter connection error: {e}")
+                return
 
+            if response.status_code != 200:
+                print(f"[Paperless] Filter HTTP {response.status_code}: {response.text[:200]}")
+                return
 
-def download_document(access_token, base_url, doc_id):
-    url = urllib.parse.urljoin(base_url, f"api/documents/{doc_id}/download/")
-    headers = {
-        "Authorization": f"Token {access_token}",
-        "Accept": "application/json",
-    }
+            search_data = safe_json(response)
+            documents = search_data.get("results", [])
+            print(f"[Paperless] Filter results: {[doc.get('id') for doc in documents]}")
+            yield from documents
 
-    try:
-        response = requests.get(url, headers=headers, stream=True, timeout=DEFAULT_TIMEOUT)
-        if response.status_code == 200:
-            document_binary = b''.join(response.iter_content(chunk_size=8192))
-            print(f"[Paperless] Document #{doc_id} downloaded successfully ({len(document_binary)} bytes).")
-            return document_binary
-        else:
+            url = search_data.get("next")
+
+    def filter_documents_by_tags(self, tags, page_size=PAGE_SIZE, document_ids=None):
+        """Yields the IDs of all documents carrying every tag in `tags`, see `list_documents`."""
+        for doc in self.list_documents(tags, page_size=page_size, document_ids=document_ids, fields=("id",)):
+            yield doc.get("id")
+
+    def download_document(self, doc_id):
+        url = urllib.parse.urljoin(self.base_url, f"api/documents/{doc_id}/download/")
+
+        try:
+            with metrics.timed("paperless", "download") as call:
+                response = self.session.get(url, stream=True, timeout=self.timeout)
+                call.status = response.status_code
+                if response.status_code == 200:
+                    document_binary = b''.join(response.iter_content(chunk_size=8192))
+            if response.status_code == 200:
+                metrics.TRANSFERRED_BYTES.inc(len(document_binary), service="paperless", direction="download")
+                print(f"[Paperless] Document #{doc_id} downloaded successfully ({len(document_binary)} bytes).")
+                return document_binary
+            else:
+                print(f"[Paperless] Download failed HTTP {response.status_code}: {response.text[:200]}")
+                return None
+
+        except requests.RequestException as e:
+            print(f"[Paperless] Download connection error: {e}")
+            return None
+
+    def stream_document(self, doc_id, chunk_size=CHUNK_SIZE):
+        """
+        Starts the download of a document without reading its body.
+        Returns a tuple (chunks, size) where `chunks` yields the document in pieces of
+        `chunk_size` bytes and releases the connection once exhausted, and `size` is the
+        document size in bytes if paperless announced it, else None.
+        Returns None if the download could not be started.
+        """
+        url = urllib.parse.urljoin(self.base_url, f"api/documents/{doc_id}/download/")
+
+        try:
+            with metrics.timed("paperless", "stream") as call:
+                response = self.session.get(url, stream=True, timeout=self.timeout)
+                call.status = response.status_code
+        except requests.RequestException as e:
+            print(f"[Paperless] Download connection error: {e}")
+            return None
+
+        if response.status_code != 200:
             print(f"[Paperless] Download failed HTTP {response.status_code}: {response.text[:200]}")
+            response.close()
             return None
 
-    except requests.RequestException as e:
-        print(f"[Paperless] Download connection error: {e}")
-        return None
+        # With a content encoding the announced length is that of the encoded body, not of the document
+        size = response.headers.get("Content-Length")
+        if response.headers.get("Content-Encoding", "identity") != "identity":
+            size = None
+
+        def chunks():
+            received = 0
+            with response:
+                for chunk in response.iter_content(chunk_size=chunk_size):
+                    received += len(chunk)
+                    metrics.TRANSFERRED_BYTES.inc(len(chunk), service="paperless", direction="download")
+                    yield chunk
+            print(f"[Paperless] Document #{doc_id} streamed successfully ({received} bytes).")
+
+        return chunks(), int(size) if size else None
+
+    def set_custom_field(self, document_id, field_id, field_value):
+        url = f"{self.base_url}/api/documents/{document_id}/"
+        headers = {"Content-Type": "application/json"}
+        payload = json.dumps({
+            "custom_fields": [{"value": field_value, "field": field_id}]
+        })
+
+        try:
+            with metrics.timed("paperless", "set_custom_field") as call:
+                response = self.session.patch(url, headers=headers, data=payload, timeout=self.timeout)
+                call.status = response.status_code
+            if response.status_code == 200:
+                print(f"[Paperless] Custom field set on document #{document_id}.")
+                return True
+            else:
+                print(f"[Paperless] Set custom field failed HTTP {response.status_code}: {response.text[:200]}")
+                return False
+        except requests.RequestException as e:
+            print(f"[Paperless] Custom field connection error: {e}")
+            return False
+
+    def remove_tag(self, document_id, tag_ids, current_tags=None):
+        """
+        Removes the given tags from a document. The document is fetched for its tags unless
+        they are passed as `current_tags`, e.g. as seen in the listing.
+        """
+        url = urllib.parse.urljoin(self.base_url, f"api/documents/{document_id}/")
+        headers = {"Content-Type": "application/json"}
+
+        try:
+            if current_tags is None:
+                with metrics.timed("paperless", "get_document") as call:
+                    response = self.session.get(url, timeout=self.timeout)
+                    call.status = response.status_code
+                if response.status_code != 200:
+                    print(f"[Paperless] Fetch document failed HTTP {response.status_code}: {response.text[:200]}")
+                    return False
+                current_tags = safe_json(response).get("tags", [])
+
+            new_tags = [tag for tag in current_tags if tag not in map(int, tag_ids)]
+
+            payload = json.dumps({"tags": new_tags})
+            with metrics.timed("paperless", "remove_tag") as call:
+                patch_resp = self.session.patch(url, headers=headers, data=payload, timeout=self.timeout)
+                call.status = patch_resp.status_code
+            if patch_resp.status_code == 200:
+                print(f"[Paperless] Removed tag IDs {tag_ids} from document #{document_id}.")
+                return True
+            else:
+                print(f"[Paperless] Remove tag failed HTTP {patch_resp.status_code}: {patch_resp.text[:200]}")
+                return False
+
+        except requests.RequestException as e:
+            print(f"[Paperless] Remove tag connection error: {e}")
+            return False
+
+    def bulk_edit(self, document_ids, method, parameters):
+        """Applies one bulk_edit `method` to all given documents in a single request. Returns True on success."""
+        url = urllib.parse.urljoin(self.base_url, "api/documents/bulk_edit/")
+        payload = {"documents": list(document_ids), "method": method, "parameters": parameters}
+
+        try:
+            with metrics.timed("paperless", "bulk_edit") as call:
+                response = self.session.post(url, json=payload, timeout=self.timeout)
+                call.status = response.status_code
+            if response.status_code == 200:
+                print(f"[Paperless] Bulk edit {method} applied to documents {list(document_ids)}.")
+                return True
+            print(f"[Paperless] Bulk edit {method} failed HTTP {response.status_code}: {response.text[:200]}")
+            return False
+        except requests.RequestException as e:
+            print(f"[Paperless] Bulk edit connection error: {e}")
+            return False
+
+    def remove_tags(self, document_ids, tag_ids, current_tags=None):
+        """
+        Removes the given tags from many documents with one bulk edit per tag.
+        If a bulk edit is rejected, falls back to updating the documents one by one so
+        failures are known per document, using the tags in the dict document ID -> tags
+        `current_tags` where known. Returns a dict document ID -> success.
+        """
+        current_tags = current_tags or {}
+        document_ids = list(document_ids)
+        if not document_ids:
+            return {}
+
+        if all(self.bulk_edit(document_ids, "remove_tag", {"tag": int(tag_id)}) for tag_id in tag_ids):
+            return {document_id: True for document_id in document_ids}
+
+        print("[Paperless] Bulk tag removal failed, falling back to single document updates...")
+        return {
+            document_id: self.remove_tag(document_id, tag_ids, current_tags=current_tags.get(document_id))
+            for document_id in document_ids
+        }
+
+
+def get_client(access_token, base_url):
+    """Returns the shared client for the given paperless instance, creating it on first use."""
+    key = (access_token, base_url)
+    with _clients_lock:
+        if key not in _clients:
+            _clients[key] = PaperlessClient(access_token, base_url)
+        return _clients[key]
+
+
+def search_documents(access_token, base_url, search_string):
+    return get_client(access_token, base_url).search_documents(search_string)
+
+
+def list_documents(access_token, base_url, tags, page_size=PAGE_SIZE, document_ids=None, modified_after=None, ordering=None,
+                   fields=LISTING_FIELDS, query=None, created_after=None, created_before=None):
+    return get_client(access_token, base_url).list_documents(
+        tags, page_size=page_size, document_ids=document_ids, modified_after=modified_after, ordering=ordering,
+        fields=fields, query=query, created_after=created_after, created_before=created_before
+    )
+
+
+def filter_documents_by_tags(access_token, base_url, tags, page_size=PAGE_SIZE, document_ids=None):
+    return get_client(access_token, base_url).filter_documents_by_tags(tags, page_size=page_size, document_ids=document_ids)
+
+
+def download_document(access_token, base_url, doc_id):
+    return get_client(access_token, base_url).download_document(doc_id)
+
+
+def stream_document(access_token, base_url, doc_id, chunk_size=CHUNK_SIZE):
+    return get_client(access_token, base_url).stream_document(doc_id, chunk_size=chunk_size)
 
 
 def set_custom_field(access_token, base_url, document_id, field_id, field_value):
-    url = f"{base_url}/api/documents/{document_id}/"
-    headers = {
-        "Authorization": f"Token {access_token}",
-        "Content-Type": "application/json",
-    }
-    payload = json.dumps({
-        "custom_fields": [{"value": field_value, "field": field_id}]
-    })
+    return get_client(access_token, base_url).set_custom_field(document_id, field_id, field_value)
 
-    try:
-        response = requests.patch(url, headers=headers, data=payload, timeout=DEFAULT_TIMEOUT)
-        if response.status_code == 200:
-            print(f"[Paperless] Custom field set on document #{document_id}.")
-        else:
-            print(f"[Paperless] Set custom field failed HTTP {response.status_code}: {response.text[:200]}")
-    except requests.RequestException as e:
-        print(f"[Paperless] Custom field connection error: {e}")
-
-
-def remove_tag(access_token, base_url, document_id, tag_ids):
-    url = urllib.parse.urljoin(base_url, f"api/documents/{document_id}/")
-    headers = {
-        "Authorization": f"Token {access_token}",
-        "Content-Type": "application/json",
-    }
 
-    try:
-        response = requests.get(url, headers=headers, timeout=DEFAULT_TIMEOUT)
-        if response.status_code != 200:
-            print(f"[Paperless] Fetch document failed HTTP {response.status_code}: {response.text[:200]}")
-            return
-
-        doc_data = safe_json(response)
-        current_tags = doc_data.get("tags", [])
-        new_tags = [tag for tag in current_tags if tag not in map(int, tag_ids)]
-
-        payload = json.dumps({"tags": new_tags})
-        patch_resp = requests.patch(url, headers=headers, data=payload, timeout=DEFAULT_TIMEOUT)
-        if patch_resp.status_code == 200:
-            print(f"[Paperless] Removed tag IDs {tag_ids} from document #{document_id}.")
-        else:
-            print(f"[Paperless] Remove tag failed HTTP {patch_resp.status_code}: {patch_resp.text[:200]}")
-
-    except requests.RequestException as e:
-        print(f"[Paperless] Remove tag connection error: {e}")
+def remove_tag(access_token, base_url, document_id, tag_ids, current_tags=None):
+    return get_client(access_token, base_url).remove_tag(document_id, tag_ids, current_tags=current_tags)
+
+
+def remove_tags(access_token, base_url, document_ids, tag_ids, current_tags=None):
+    return get_client(access_token, base_url).remove_tags(document_ids, tag_ids, current_tags=current_tags)
@@ -0,0 +1,541 @@
+import os
+import re
+import asyncio
+import sqlite3
+import hashlib
+import functools
+import time
+import paperless
+import lexoffice
+import metrics
+import compression
+from journal import UPLOADED, WRITTEN_BACK
+from dedupe import DuplicateContent, new_hash
+from breaker import CLOSED, HALF_OPEN
+
+DOWNLOAD_CONCURRENCY = int(os.getenv("DOWNLOAD_CONCURRENCY", 4))
+UPLOAD_CONCURRENCY = int(os.getenv("UPLOAD_CONCURRENCY", 2))
+WRITEBACK_CONCURRENCY = int(os.getenv("WRITEBACK_CONCURRENCY", 4))
+WRITEBACK_BATCH_SIZE = int(os.getenv("WRITEBACK_BATCH_SIZE", 50))
+QUEUE_SIZE = int(os.getenv("PIPELINE_QUEUE_SIZE", 8))
+STREAMING_TRANSFER = os.getenv("STREAMING_TRANSFER", "false").lower() == "true"
+
+TMP_DIR = "tmp"
+QUEUE_SAMPLE_INTERVAL = 1  # seconds between queue depth samples
+
+LEXOFFICE_VOUCHER_PREVIEW_URL = "https://app.lexware.de/vouchers#!/VoucherList//PurchaseInvoice/"
+
+
+def voucher_preview_url(lexoffice_document_uuid):
+    return f"{LEXOFFICE_VOUCHER_PREVIEW_URL}{lexoffice_document_uuid}?filter=unchecked&sort=sortByLastModifiedDate&sortDirection=desc"
+
+
+def upload_filename(document, doc_id):
+    """
+    Name of the uploaded file: the original file name as known to paperless, with the `.pdf`
+    extension of the archived version paperless serves, or `<id>.pdf` if unknown.
+    """
+    original = (document or {}).get("original_file_name")
+    if not original:
+        return f"{doc_id}.pdf"
+    # The name ends up in a multipart header, quotes and line breaks would break it
+    stem = re.sub(r'["\\\r\n]', "", os.path.splitext(os.path.basename(original))[0])
+    return f"{stem or doc_id}.pdf"
+
+
+def _write_file(filepath, content):
+    with open(filepath, "wb") as file:
+        file.write(content)
+
+
+class SyncPipeline:
+    """
+    Moves documents from paperless-ngx to lexoffice in three stages (download, upload,
+    paperless write-back), each served by its own pool of workers and connected by bounded
+    queues. The blocking HTTP calls run in worker threads so the event loop stays free.
+    In streaming mode download and upload are fused into a single transfer stage which pipes
+    the paperless response straight into the lexoffice upload, without a file in tmp.
+    With a journal, progress is recorded per document: documents already uploaded skip straight
+    to the write-back, and documents backing off after failures are left out until they are due.
+    With a dedupe index, documents whose content was uploaded before are not uploaded again but
+    linked to the existing voucher.
+    With compression, large downloads pass through an extra stage shrinking their images on a
+    process pool before they are uploaded (not in streaming mode, which never holds the file).
+    With a lease store, only documents this worker could claim are fed, so several workers can
+    share one backlog.
+    With an upload batch size above 1, downloaded documents are collected and uploaded several
+    per request, see `LexofficeClient.upload_vouchers` (not in streaming mode either).
+    """
+
+    def __init__(self, paperless_token, paperless_url, lexoffice_tag_id,
+                 lexoffice_username=None, lexoffice_password=None, custom_field_id_preview_url=None,
+                 download_concurrency=DOWNLOAD_CONCURRENCY, upload_concurrency=UPLOAD_CONCURRENCY,
+                 writeback_concurrency=WRITEBACK_CONCURRENCY, queue_size=QUEUE_SIZE,
+                 streaming=STREAMING_TRANSFER, writeback_batch_size=WRITEBACK_BATCH_SIZE, journal=None,
+                 dedupe=None, lexoffice_client=None, executor=None, tmp_dir=TMP_DIR, name="default", leases=None,
+                 compress=None, upload_batch_size=lexoffice.UPLOAD_BATCH_SIZE):
+        self.paperless_token = paperless_token
+        self.paperless_url = paperless_url
+        self.lexoffice_tag_id = lexoffice_tag_id
+        self.lexoffice = lexoffice_client or lexoffice.get_client(lexoffice_username, lexoffice_password)
+        self.executor = executor
+        self.tmp_dir = tmp_dir
+        self.name = name
+        self.leases = leases
+        self.compress = compression.is_enabled() if compress is None else compress
+        if self.compress and streaming:
+            print("[Sync] Compression needs the whole document, it is skipped in streaming mode.")
+        self.upload_batch_size = upload_batch_size
+        if upload_batch_size > 1 and streaming:
+            print("[Sync] Batched uploads need the whole documents, they are skipped in streaming mode.")
+        self.custom_field_id_preview_url = custom_field_id_preview_url
+        self.download_concurrency = download_concurrency
+        self.upload_concurrency = upload_concurrency
+        self.writeback_concurrency = writeback_concurrency
+        self.queue_size = queue_size
+        self.streaming = streaming
+        self.writeback_batch_size = writeback_batch_size
+        self.journal = journal
+        self.dedupe = dedupe
+        self._write_back_batch = []
+        self._upload_batch = []
+        self._upload_batch_bytes = 0
+        self._write_back_queue = None
+        self._completed = set()
+        self._releases = set()  # pending lease releases, see _release_lease
+        self._awaiting_write_back = set()  # uploaded documents whose lease is kept until they are written back
+        self._probes = set()  # documents let through by a half-open breaker that did not reach lexoffice yet
+        self.metadata = {}  # document ID -> fields seen in the listing, for the lifetime of this pipeline (a cycle)
+        self.stage_stats = {}  # stage -> [documents, seconds], over all runs of this pipeline
+        self.failures = 0
+        self.duplicates = 0
+        self.deferred = 0  # documents left for a later cycle while lexoffice was unavailable
+
+    @property
+    def batch_uploads(self):
+        return self.upload_batch_size > 1 and not self.streaming
+
+    def _stages(self):
+        """Returns the (name, handler, concurrency) of every stage, in the order documents pass them."""
+        if self.streaming:
+            transfer = [("transfer", self._transfer, self.upload_concurrency)]
+        else:
+            transfer = [("download", self._download, self.download_concurrency)]
+            if self.compress:
+                transfer.append(("compress", self._compress, compression.COMPRESS_WORKERS))
+            transfer.append(("upload", self._upload, self.upload_concurrency))
+        return transfer + [("write_back", self._write_back, self.writeback_concurrency)]
+
+    async def run(self, documents, skip=None, completed=None):
+        """
+        Feeds the document IDs yielded by the (blocking) iterator `documents` through the
+        pipeline and returns once every document has left the last stage.
+        IDs contained in `skip` are ignored; every fed ID is added to it.
+        The IDs of documents that made it through all stages are added to `completed`.
+        Returns the number of documents fed into the pipeline, not counting those deferred
+        because lexoffice was unavailable: they are no work done.
+        """
+        skip = skip if skip is not None else set()
+        self._completed = completed if completed is not None else set()
+        stages = self._stages()
+        queues = [asyncio.Queue(self.queue_size) for _ in stages]
+        self._write_back_queue = queues[-1]
+        workers = [
+            asyncio.create_task(self._worker(stage, queues[i], handler, queues[i + 1] if i + 1 < len(queues) else None))
+            for i, (stage, handler, concurrency) in enumerate(stages)
+            for _ in range(concurrency)
+        ]
+        workers.append(asyncio.create_task(self._sample_queues(stages, queues)))
+        if self.leases:
+            workers.append(asyncio.create_task(self._renew_leases()))
+
+        fed = 0
+        deferred = self.deferred
+        try:
+            while (doc_id := await self._call(next, documents, None)) is not None:
+                if doc_id in skip:
+                    continue
+                skip.add(doc_id)
+
+                job = self.journal.get(doc_id) if self.journal else None
+                if job and job["stage"] == WRITTEN_BACK:
+                    # Tagged for upload again after a completed sync, so it is a new job
+                    self.journal.restart(doc_id)
+                    job = None
+                if self.journal and not self.journal.is_due(job):
+                    print(f"[Sync] Document #{doc_id} is backing off after {job['attempts']} failed attempt(s), skipping.")
+                    continue
+                if self.leases and not await self._call(self.leases.claim, doc_id):
+                    print(f"[Sync] Document #{doc_id} is claimed by another worker, skipping.")
+                    continue
+
+                fed += 1
+                voucher_id = job["voucher_id"] if job and job["stage"] == UPLOADED else None
+                if voucher_id is None and self.leases:
+                    # Uploaded by a worker that failed to write it back, even without a shared journal
+                    voucher_id = await self._call(self.leases.uploaded_voucher, doc_id)
+                if voucher_id:
+                    print(f"[Sync] Document #{doc_id} was already uploaded as voucher {voucher_id}, only writing back...")
+                    await queues[-1].put((doc_id, voucher_id))
+                else:
+                    await queues[0].put((doc_id,))
+
+            # Stages drain front to back, so once a queue is joined nothing can be added to it anymore
+            for (stage, _, _), queue in zip(stages, queues):
+                await queue.join()
+                if stage == "upload":
+                    await self._flush_uploads()
+            await self._flush_write_back()
+        finally:
+            for worker in workers:
+                worker.cancel()
+            await asyncio.gather(*workers, *self._releases, return_exceptions=True)
+            for stage, _, _ in stages:
+                metrics.QUEUE_DEPTH.set(0, tenant=self.name, stage=stage)
+
+        return fed - (self.deferred - deferred)
+
+    def remember(self, documents):
+        """Passes the listed `documents` through, keeping their fields in `metadata`."""
+        for document in documents:
+            self.metadata[document.get("id")] = {field: document.get(field) for field in paperless.LISTING_FIELDS}
+            yield document
+
+    async def _worker(self, stage, queue, handler, next_queue=None):
+        while True:
+            item = await queue.get()
+            started = time.monotonic()
+            try:
+                result = await handler(*item)
+                # Write-backs (and batched uploads) are only collected here, they are measured per batch when flushed
+                if stage != "write_back" and not (stage == "upload" and self.batch_uploads):
+                    self._observe(stage, time.monotonic() - started)
+                if result is not None and next_queue is not None:
+                    await next_queue.put(result)
+            except Exception as e:
+                print(f"[Sync] An error occurred while processing document #{item[0]}: {e}")
+                self._failed(item[0], e)
+            finally:
+                queue.task_done()
+
+    async def _sample_queues(self, stages, queues):
+        while True:
+            for (stage, _, _), queue in zip(stages, queues):
+                metrics.QUEUE_DEPTH.set(queue.qsize(), tenant=self.name, stage=stage)
+            await asyncio.sleep(QUEUE_SAMPLE_INTERVAL)
+
+    async def _renew_leases(self):
+        while True:
+            await asyncio.sleep(self.leases.ttl / 3)
+            await self._call(self.leases.renew)
+
+    def _observe(self, stage, seconds, documents=1):
+        stats = self.stage_stats.setdefault(stage, [0, 0.0])
+        stats[0] += documents
+        stats[1] += seconds
+        metrics.STAGE_DURATION.observe(seconds / documents, tenant=self.name, stage=stage)
+
+    def summary(self):
+        """Describes the average time documents spent in every stage, e.g. `download 10x 0.21s`."""
+        return ", ".join(
+            f"{stage} {documents}x {seconds / documents:.2f}s"
+            for stage, (documents, seconds) in self.stage_stats.items()
+        )
+
+    async def _lexoffice_available(self, doc_id):
+        """
+        Documents are only fetched while lexoffice can take them, see `LexofficeClient.upload_breaker`.
+        While a probe is under way, further documents wait for its outcome.
+        """
+        while not self.lexoffice.upload_breaker.allow_request():
+            if self.lexoffice.upload_breaker.state != HALF_OPEN:
+                break
+            await asyncio.sleep(1)
+        else:
+            if self.lexoffice.upload_breaker.state == HALF_OPEN:
+                self._probes.add(doc_id)
+            return True
+        print(f"[Sync] lexoffice is unavailable, not downloading document #{doc_id} until it recovers.")
+        return False
+
+    async def _download(self, doc_id):
+        if not await self._lexoffice_available(doc_id):
+            self._deferred(doc_id)
+            return None
+
+        file_content = await self._call(
+            paperless.download_document, self.paperless_token, self.paperless_url, doc_id
+        )
+        if file_content is None:
+            self._failed(doc_id, "download failed")
+            return None
+
+        os.makedirs(self.tmp_dir, exist_ok=True)
+        filepath = os.path.join(self.tmp_dir, f"{doc_id}.pdf")
+        await self._call(_write_file, filepath, file_content)
+        if self.journal:
+            self.journal.mark_downloaded(doc_id)
+
+        digest = None
+        if self.dedupe:
+            digest = await self._call(lambda: hashlib.sha256(file_content).hexdigest())
+        return doc_id, filepath, digest
+
+    async def _compress(self, doc_id, filepath, digest=None):
+        """Shrinks large documents, keeping the original if the result is not smaller."""
+        size = os.path.getsize(filepath)
+        if size < compression.COMPRESS_MIN_SIZE:
+            return doc_id, filepath, digest
+
+        compressed_path = f"{filepath}.compressed"
+        try:
+            compressed_size = await asyncio.get_running_loop().run_in_executor(
+                compression.get_pool(), compression.compress_pdf, filepath, compressed_path
+            )
+        except Exception as e:
+            print(f"[Sync] Could not compress document #{doc_id}, uploading the original: {e}")
+            compressed_size = None
+
+        if compressed_size is not None and compressed_size < size:
+            os.replace(compressed_path, filepath)
+            metrics.COMPRESSION_SAVED_BYTES.inc(size - compressed_size, tenant=self.name)
+            print(f"[Sync] Compressed document #{doc_id} from {size} to {compressed_size} bytes.")
+        else:
+            if os.path.exists(compressed_path):
+                os.remove(compressed_path)
+            if compressed_size is not None:
+                print(f"[Sync] Compression did not shrink document #{doc_id}, uploading the original.")
+        # The digest stays that of the original, it is what paperless serves on the next download
+        return doc_id, filepath, digest
+
+    async def _upload(self, doc_id, filepath, digest=None):
+        voucher_id = await self._call(self.dedupe.lookup, digest) if digest else None
+        if voucher_id:
+            os.remove(filepath)
+            return self._duplicate(doc_id, voucher_id)
+
+        if self.batch_uploads:
+            self._upload_batch.append((doc_id, filepath, digest))
+            self._upload_batch_bytes += os.path.getsize(filepath)
+            # While the breaker is not closed the downloads wait for the probe, which must not wait for a full batch
+            if (len(self._upload_batch) >= self.upload_batch_size
+                    or self._upload_batch_bytes >= lexoffice.UPLOAD_BATCH_MAX_BYTES
+                    or self.lexoffice.upload_breaker.state != CLOSED):
+                await self._flush_uploads()
+            return None
+
+        try:
+            lexoffice_document_uuid = await self._call(
+                self.lexoffice.upload_voucher, filepath, filename=upload_filename(self.metadata.get(doc_id), doc_id)
+            )
+        finally:
+            os.remove(filepath)
+        return await self._uploaded(doc_id, lexoffice_document_uuid, digest)
+
+    async def _flush_uploads(self):
+        """
+        Uploads the collected documents with as few requests as lexoffice takes and passes the
+        uploaded ones on to the write-back.
+        """
+        batch, self._upload_batch, self._upload_batch_bytes = self._upload_batch, [], 0
+        if not batch:
+            return
+        started = time.monotonic()
+        try:
+            voucher_ids = await self._call(
+                self.lexoffice.upload_vouchers,
+                [(filepath, upload_filename(self.metadata.get(doc_id), doc_id)) for doc_id, filepath, _ in batch],
+                batch_size=self.upload_batch_size,
+            )
+        except Exception as e:
+            print(f"[Sync] An error occurred while uploading documents {[doc_id for doc_id, _, _ in batch]}: {e}")
+            voucher_ids = [None] * len(batch)
+        finally:
+            for _, filepath, _ in batch:
+                os.remove(filepath)
+        self._observe("upload", time.monotonic() - started, documents=len(batch))
+
+        for (doc_id, _, digest), lexoffice_document_uuid in zip(batch, voucher_ids):
+            result = await self._uploaded(doc_id, lexoffice_document_uuid, digest)
+            if result:
+                await self._write_back_queue.put(result)
+
+    async def _uploaded(self, doc_id, lexoffice_document_uuid, digest=None):
+        """Records the outcome of an upload, returns the item for the write-back if it succeeded."""
+        self._probes.discard(doc_id)  # lexoffice has answered, the breaker knows the outcome
+        if not lexoffice_document_uuid:
+            print(f"[Sync] Upload of document #{doc_id} not successful. Deleted file from tmp as it gets downloaded in the next cycle.")
+            self._failed(doc_id, "upload failed")
+            return None
+
+        if self.journal:
+            self.journal.mark_uploaded(doc_id, lexoffice_document_uuid)
+        if digest:
+            await self._call(self.dedupe.add, digest, lexoffice_document_uuid)
+        print(f"[Sync] Upload of document #{doc_id} successful. Deleted file from tmp.")
+        return doc_id, lexoffice_document_uuid
+
+    async def _transfer(self, doc_id):
+        if not await self._lexoffice_available(doc_id):
+            self._deferred(doc_id)
+            return None
+
+        stream = await self._call(
+            paperless.stream_document, self.paperless_token, self.paperless_url, doc_id
+        )
+        if stream is None:
+            self._failed(doc_id, "download failed")
+            return None
+
+        def reopen():
+            stream = paperless.stream_document(self.paperless_token, self.paperless_url, doc_id)
+            return stream[0] if stream else None
+
+        chunks, size = stream
+        hasher = None
+        if self.dedupe:
+            # The content is only known once streamed, a duplicate aborts the upload before it completes
+            hasher = new_hash()
+            chunks = self.dedupe.hashing(chunks, hasher)
+
+        try:
+            lexoffice_document_uuid = await self._call(
+                self.lexoffice.upload_voucher_stream,
+                chunks,
+                upload_filename(self.metadata.get(doc_id), doc_id),
+                reopen,
+                size=size
+            )
+        except DuplicateContent as e:
+            return self._duplicate(doc_id, e.voucher_id)
+        self._probes.discard(doc_id)
+
+        if not lexoffice_document_uuid:
+            print(f"[Sync] Transfer of document #{doc_id} not successful, it gets transferred again in the next cycle.")
+            self._failed(doc_id, "upload failed")
+            return None
+
+        if self.journal:
+            self.journal.mark_uploaded(doc_id, lexoffice_document_uuid)
+        if hasher:
+            await self._call(self.dedupe.add, hasher.hexdigest(), lexoffice_document_uuid)
+        print(f"[Sync] Transfer of document #{doc_id} successful.")
+        return doc_id, lexoffice_document_uuid
+
+    async def _write_back(self, doc_id, lexoffice_document_uuid):
+        self._awaiting_write_back.add(doc_id)
+        if self.leases:
+            await self._call(self.leases.record_upload, doc_id, lexoffice_document_uuid)
+        self._write_back_batch.append((doc_id, lexoffice_document_uuid))
+        if len(self._write_back_batch) >= self.writeback_batch_size:
+            await self._flush_write_back()
+
+    async def _flush_write_back(self):
+        """
+        Writes the collected uploads back to paperless: the lexoffice tag is removed from the
+        whole batch with a single bulk edit, and the preview URLs, which differ per document,
+        are set with one request each. Returns a dict document ID -> success.
+        """
+        batch, self._write_back_batch = self._write_back_batch, []
+        if not batch:
+            return {}
+        started = time.monotonic()
+
+        # Tags as listed, so a failed bulk edit does not have to fetch every document again
+        current_tags = {
+            doc_id: self.metadata[doc_id]["tags"]
+            for doc_id, _ in batch
+            if self.metadata.get(doc_id, {}).get("tags") is not None
+        }
+        results = await self._call(
+            paperless.remove_tags, self.paperless_token, self.paperless_url,
+            [doc_id for doc_id, _ in batch], [self.lexoffice_tag_id], current_tags
+        )
+
+        if self.custom_field_id_preview_url:
+            print(f"[Sync] Adding voucher preview URLs as custom field to {len(batch)} documents...")
+            semaphore = asyncio.Semaphore(self.writeback_concurrency)
+
+            async def set_preview_url(doc_id, lexoffice_document_uuid):
+                async with semaphore:
+                    return await self._call(
+                        paperless.set_custom_field, self.paperless_token, self.paperless_url, doc_id,
+                        self.custom_field_id_preview_url, voucher_preview_url(lexoffice_document_uuid)
+                    )
+
+            field_results = await asyncio.gather(*(set_preview_url(*item) for item in batch))
+            for (doc_id, _), ok in zip(batch, field_results):
+                results[doc_id] = results[doc_id] and ok
+
+        self._observe("write_back", time.monotonic() - started, documents=len(batch))
+        for doc_id, ok in results.items():
+            if ok:
+                self._completed.add(doc_id)
+                metrics.DOCUMENTS.inc(tenant=self.name, result="synced")
+                self._awaiting_write_back.discard(doc_id)
+                self._release_lease(doc_id)
+                if self.journal:
+                    self.journal.mark_written_back(doc_id)
+            else:
+                print(f"[Sync] Write-back of document #{doc_id} to paperless failed.")
+                self._failed(doc_id, "write-back failed")
+        return results
+
+    async def _call(self, func, *args, **kwargs):
+        """Runs a blocking call on the pipeline's executor (or the default one) without blocking the event loop."""
+        return await asyncio.get_running_loop().run_in_executor(self.executor, functools.partial(func, *args, **kwargs))
+
+    def _release_lease(self, doc_id):
+        """
+        Releases the lease on the document in the background: the shared lease file may be
+        locked by another worker for a while, which must not stall the event loop.
+        """
+        if not self.leases:
+            return
+        future = asyncio.get_running_loop().run_in_executor(self.executor, self._release_lease_now, doc_id)
+        self._releases.add(future)
+        future.add_done_callback(self._releases.discard)
+
+    def _release_lease_now(self, doc_id):
+        try:
+            self.leases.release(doc_id)
+        except sqlite3.Error as e:
+            # It expires after LEASE_TTL instead
+            print(f"[Sync] Could not release the lease on document #{doc_id}: {e}")
+
+    def _abandon_probe(self, doc_id):
+        """Frees the probe slot of the breaker if `doc_id` was the probe and never reached lexoffice."""
+        if doc_id in self._probes:
+            self._probes.discard(doc_id)
+            self.lexoffice.upload_breaker.release_probe()
+
+    def _deferred(self, doc_id):
+        """
+        Leaves the document for a later cycle without counting a failed attempt, so it does not
+        back off, and frees its lease: another worker, whose lexoffice may be healthy, can take it.
+        """
+        self.deferred += 1
+        metrics.DOCUMENTS.inc(tenant=self.name, result="deferred")
+        self._release_lease(doc_id)
+
+    def _duplicate(self, doc_id, voucher_id):
+        print(f"[Sync] Document #{doc_id} has the same content as voucher {voucher_id}, skipping the upload.")
+        self._abandon_probe(doc_id)
+        self.duplicates += 1
+        metrics.DOCUMENTS.inc(tenant=self.name, result="duplicate")
+        if self.journal:
+            self.journal.mark_uploaded(doc_id, voucher_id)
+        return doc_id, voucher_id
+
+    def _failed(self, doc_id, error):
+        self.failures += 1
+        self._abandon_probe(doc_id)
+        metrics.DOCUMENTS.inc(tenant=self.name, result="failed")
+        if doc_id not in self._awaiting_write_back:
+            self._release_lease(doc_id)
+        if self.journal:
+            try:
+                self.journal.mark_failed(doc_id, error)
+            except sqlite3.Error as e:
+                # Called from the workers' error handling, which must survive to keep the queues draining
+                print(f"[Sync] Could not record the failure of document #{doc_id} in the journal: {e}")
@@ -0,0 +1,85 @@
+import os
+import time
+import threading
+from email.utils import parsedate_to_datetime
+
+UPLOAD_RATE = float(os.getenv("UPLOAD_RATE", 2))  # uploads per second to start with
+UPLOAD_RATE_MIN = float(os.getenv("UPLOAD_RATE_MIN", 0.1))
+UPLOAD_RATE_MAX = float(os.getenv("UPLOAD_RATE_MAX", 20))
+UPLOAD_BURST = float(os.getenv("UPLOAD_BURST", 2))  # uploads allowed back to back after an idle period
+UPLOAD_LATENCY_TARGET = float(os.getenv("UPLOAD_LATENCY_TARGET", 10))  # seconds, slower uploads lower the rate
+
+RATE_INCREASE = 0.1  # uploads per second added after every fast upload
+RATE_DECREASE = 0.5  # factor applied to the rate when throttled
+SLOW_DECREASE = 0.9  # factor applied to the rate after a slow upload
+DEFAULT_RETRY_AFTER = 5  # seconds to pause when throttled without Retry-After header
+
+
+def parse_retry_after(value):
+    """Returns the delay in seconds announced by a Retry-After header (seconds or HTTP date), or None."""
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+class AdaptiveRateLimiter:
+    """
+    Token bucket shared by all upload workers, whose rate follows what lexoffice accepts (AIMD):
+    every upload answered within the latency target raises the rate a little, while a throttling
+    response (429/503) halves it and pauses all uploads for the announced Retry-After, and slow
+    answers lower it slightly.
+    """
+
+    def __init__(self, rate=UPLOAD_RATE, min_rate=UPLOAD_RATE_MIN, max_rate=UPLOAD_RATE_MAX,
+                 burst=UPLOAD_BURST, latency_target=UPLOAD_LATENCY_TARGET):
+        self.rate = rate
+        self.min_rate = min_rate
+        self.max_rate = max_rate
+        self.burst = burst
+        self.latency_target = latency_target
+        self._tokens = burst
+        self._updated = time.monotonic()
+        self._blocked_until = 0.0
+        self._last_decrease = 0.0
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        """Blocks until the caller may send the next upload."""
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+            self._updated = now
+            # Take the token right away, a negative balance queues the callers behind each other
+            self._tokens -= 1
+            wait = max(-self._tokens / self.rate, self._blocked_until - now)
+        if wait > 0:
+            time.sleep(wait)
+
+    def succeeded(self, latency):
+        with self._lock:
+            if latency <= self.latency_target:
+                self.rate = min(self.max_rate, self.rate + RATE_INCREASE)
+            else:
+                self.rate = max(self.min_rate, self.rate * SLOW_DECREASE)
+
+    def throttled(self, retry_after=None, sent_at=None):
+        """
+        Lowers the rate and pauses all uploads. Returns the pause in seconds.
+        Uploads sent (at monotonic time `sent_at`) before the last decrease were still paced
+        at the old rate, so their throttling does not lower the rate again.
+        """
+        delay = retry_after if retry_after is not None else DEFAULT_RETRY_AFTER
+        with self._lock:
+            if sent_at is None or sent_at > self._last_decrease:
+                self.rate = max(self.min_rate, self.rate * RATE_DECREASE)
+                self._last_decrease = time.monotonic()
+            self._blocked_until = max(self._blocked_until, time.monotonic() + delay)
+            self._tokens = min(self._tokens, 0)
+        return delay
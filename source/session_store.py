@@ -0,0 +1,94 @@
+import os
+import json
+import time
+import base64
+import hashlib
+
+# Try to import the encryption dependency
+CRYPTOGRAPHY_AVAILABLE = False
+try:
+    from cryptography.fernet import Fernet, InvalidToken
+    CRYPTOGRAPHY_AVAILABLE = True
+except ImportError as e:
+    print(f"[SessionStore] Warning: cryptography not available. Persistent lexoffice session disabled. Error: {e}")
+
+SESSION_STORE_PATH = os.getenv("LEXOFFICE_SESSION_STORE")
+SESSION_STORE_KEY = os.getenv("LEXOFFICE_SESSION_KEY")
+
+
+class SessionStore:
+    """
+    Encrypted file holding the cookies of a lexoffice session, so the session survives restarts.
+    Disabled unless both a path and a key are given and cryptography is installed.
+    """
+
+    def __init__(self, path=SESSION_STORE_PATH, key=SESSION_STORE_KEY):
+        self.path = path
+        self.key = key
+
+    def is_enabled(self):
+        return CRYPTOGRAPHY_AVAILABLE and bool(self.path) and bool(self.key)
+
+    def _fernet(self):
+        # Any passphrase works as key, it is stretched to the 32 bytes Fernet expects
+        key = base64.urlsafe_b64encode(hashlib.sha256(self.key.encode()).digest())
+        return Fernet(key)
+
+    def save(self, cookies):
+        """
+        Encrypts and stores browser cookies, given as dicts with at least `name`, `value`
+        and `expires` (unix timestamp, -1 for cookies without expiry).
+        """
+        if not self.is_enabled() or not cookies:
+            return
+
+        payload = json.dumps({
+            "saved_at": time.time(),
+            "cookies": [
+                {"name": c["name"], "value": c["value"], "expires": c.get("expires", -1)}
+                for c in cookies
+            ],
+        }).encode()
+
+        tmp_path = f"{self.path}.tmp"
+        try:
+            with open(tmp_path, "wb") as f:
+                f.write(self._fernet().encrypt(payload))
+            os.chmod(tmp_path, 0o600)
+            os.replace(tmp_path, self.path)
+            print(f"[SessionStore] Stored {len(cookies)} lexoffice cookies")
+        except OSError as e:
+            print(f"[SessionStore] Could not store lexoffice session: {e}")
+
+    def load(self):
+        """
+        Returns the stored cookies as a name -> value dict, leaving out expired ones.
+        Returns None if nothing usable is stored.
+        """
+        if not self.is_enabled() or not os.path.exists(self.path):
+            return None
+
+        try:
+            with open(self.path, "rb") as f:
+                payload = json.loads(self._fernet().decrypt(f.read()))
+        except (OSError, ValueError, InvalidToken) as e:
+            print(f"[SessionStore] Could not read stored lexoffice session: {e}")
+            return None
+
+        now = time.time()
+        cookies = {
+            c["name"]: c["value"]
+            for c in payload.get("cookies", [])
+            if c.get("expires", -1) <= 0 or c["expires"] > now
+        }
+        if not cookies:
+            print("[SessionStore] Stored lexoffice session has expired")
+            self.clear()
+            return None
+
+        print(f"[SessionStore] Loaded {len(cookies)} lexoffice cookies stored at {time.ctime(payload.get('saved_at'))}")
+        return cookies
+
+    def clear(self):
+        if self.is_enabled() and os.path.exists(self.path):
+            os.remove(self.path)
@@ -0,0 +1,208 @@
+import os
+import time
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+import paperless
+import lexoffice
+import polling
+import dedupe
+import metrics
+import leases
+from journal import Journal, JOURNAL_FILE
+from pipeline import SyncPipeline, TMP_DIR
+from tenants import TENANT_THREADS
+
+INCREMENTAL_POLLING = os.getenv("INCREMENTAL_POLLING", "false").lower() == "true"
+ADAPTIVE_POLLING = os.getenv("ADAPTIVE_POLLING", "false").lower() == "true"
+
+LOCK_FILE = 'script.lock'
+
+
+class TenantSync:
+    """
+    Syncs the documents of one tenant. Every tenant has its own lock, journal, poller state,
+    dedupe index and lexoffice client (with its own rate limiter and circuit breaker), so a
+    slow or failing account does not hold up the others. With `isolated` set, the blocking
+    calls of the tenant also run on a thread pool of its own instead of the shared default one.
+    """
+
+    def __init__(self, tenant, isolated=False):
+        self.tenant = tenant
+        self.log_prefix = f"[Sync {tenant.name}]" if isolated else "[Sync]"
+        self.lock_file = tenant.path(LOCK_FILE)
+        self.journal = Journal(tenant.path(JOURNAL_FILE))
+        self.dedupe = dedupe.DedupeIndex(tenant.path(dedupe.DEDUPE_FILE)) if dedupe.DEDUPE_UPLOADS else None
+        self.lexoffice = lexoffice.LexofficeClient(
+            tenant.lexoffice_username, tenant.lexoffice_password, session_store=tenant.session_store
+        )
+        self.executor = ThreadPoolExecutor(TENANT_THREADS, thread_name_prefix=tenant.name) if isolated else None
+        # With a shared lease store, workers claim single documents instead of locking the whole sync
+        self.leases = leases.LeaseStore(leases.LEASE_FILE, scope=tenant.name) if leases.LEASE_FILE else None
+
+    def log(self, message):
+        print(f"{self.log_prefix} {message}")
+
+    def create_lock(self):
+        with open(self.lock_file, 'w') as f:
+            f.write(str(os.getpid()))
+
+    def remove_lock(self):
+        if os.path.exists(self.lock_file):
+            os.remove(self.lock_file)
+
+    def is_locked(self):
+        """Tells whether another sync holds the lock. Locks left behind by a crashed process are removed."""
+        if not os.path.exists(self.lock_file):
+            return False
+
+        try:
+            with open(self.lock_file) as f:
+                pid = int(f.read().strip())
+            # Within this process syncs never overlap, so a lock carrying our own PID is from a previous
+            # container run, where this process had the same PID
+            if pid != os.getpid():
+                os.kill(pid, 0)
+                return True
+        except ProcessLookupError:
+            pass
+        except PermissionError:
+            return True  # the process exists but belongs to someone else
+        except (OSError, ValueError):
+            pass
+
+        self.log("Removing stale lock file left behind by a crashed run.")
+        self.remove_lock()
+        return False
+
+    def make_pipeline(self, **options):
+        """Returns a pipeline for one cycle of this tenant, `options` override SyncPipeline defaults."""
+        tenant = self.tenant
+        return SyncPipeline(
+            tenant.paperless_token, tenant.paperless_url, tenant.lexoffice_tag_id,
+            custom_field_id_preview_url=tenant.custom_field_id_preview_url,
+            journal=self.journal,
+            dedupe=self.dedupe,
+            lexoffice_client=self.lexoffice,
+            executor=options.pop("executor", self.executor),
+            tmp_dir=tenant.path(TMP_DIR),
+            name=tenant.name,
+            leases=self.leases,
+            **options,
+        )
+
+    async def drain(self, pipeline, list_documents, seen, completed):
+        """
+        Runs the pipeline over the listing produced by `list_documents()` until it turns up no
+        document not yet handled in this cycle: removing the lexoffice tag shifts later pages
+        of the listing, so a single pass can miss documents.
+        Returns the number of documents fed into the pipeline.
+        """
+        total = 0
+        fed = True
+        while fed:
+            self.log("Checking for new documents in paperless-ngx tagged for upload...")
+            fed = await pipeline.run(list_documents(), skip=seen, completed=completed)
+            total += fed
+        return total
+
+    async def sync_incremental(self, pipeline, tags, seen, completed):
+        """
+        Lists only documents modified since the persisted cursor, plus those whose sync did not
+        complete before. Every FULL_SYNC_INTERVAL seconds a full listing reconciles anything missed.
+        Returns the number of documents fed into the pipeline.
+        """
+        token, url = self.tenant.paperless_token, self.tenant.paperless_url
+        state = polling.PollState(self.tenant.path(polling.STATE_FILE))
+        # The cursor advances while the cycle runs, later passes still have to start where it began
+        since = state.cursor
+        if state.full_sync_due():
+            self.log("Running full reconcile...")
+            fed = await self.drain(pipeline, lambda: state.track(pipeline.remember(
+                paperless.list_documents(token, url, tags, ordering="modified,id")
+            )), seen, completed)
+            state.last_full_sync = time.time()
+        else:
+            fed = 0
+            if state.pending_ids:
+                self.log(f"Retrying documents {sorted(state.pending_ids)}...")
+                fed += await self.drain(pipeline, lambda: state.track(pipeline.remember(
+                    paperless.list_documents(token, url, tags, document_ids=state.pending_ids)
+                )), seen, completed)
+            fed += await self.drain(pipeline, lambda: state.track(
+                pipeline.remember(paperless.list_documents(token, url, tags, modified_after=since[0], ordering="modified,id")),
+                since=since
+            ), seen, completed)
+
+        state.pending_ids = seen - completed
+        state.save()
+        return fed
+
+    async def sync(self, document_ids=None):
+        """
+        Syncs all documents tagged for upload, or only those among `document_ids` if given.
+        Returns the number of documents fed into the pipeline.
+        """
+        if not self.leases:
+            if self.is_locked():
+                self.log("Script is already running. Exiting.")
+                return 0
+            self.create_lock()
+
+        fed = 0
+        started = time.monotonic()
+        seen, completed = set(), set()
+        pipeline = self.make_pipeline()
+        try:
+            tags = [self.tenant.inbox_tag_id, self.tenant.lexoffice_tag_id]
+            if INCREMENTAL_POLLING and not document_ids:
+                fed = await self.sync_incremental(pipeline, tags, seen, completed)
+            else:
+                fed = await self.drain(pipeline, lambda: (doc.get("id") for doc in pipeline.remember(
+                    paperless.list_documents(self.tenant.paperless_token, self.tenant.paperless_url, tags, document_ids=document_ids)
+                )), seen, completed)
+
+        except Exception as e:
+            self.log(f"An error occurred: {e}")
+        finally:
+            if not self.leases:
+                self.remove_lock()
+
+        duration = time.monotonic() - started
+        metrics.CYCLE_DURATION.observe(duration, tenant=self.tenant.name)
+        metrics.CYCLE_DOCUMENTS.set(fed, tenant=self.tenant.name)
+        if fed:
+            self.log(
+                f"Cycle finished in {duration:.1f}s: {fed} documents, {len(completed)} synced, "
+                f"{pipeline.duplicates} duplicates, {pipeline.failures} failures ({pipeline.summary()})"
+            )
+        if pipeline.deferred:
+            self.log(f"{pipeline.deferred} documents deferred until lexoffice is available again")
+        return fed
+
+    async def run_periodic(self):
+        interval_seconds = self.tenant.polling_interval
+        while True:
+            synced = await self.sync()
+            if ADAPTIVE_POLLING:
+                interval_seconds = polling.next_polling_interval(interval_seconds, synced)
+                self.log(f"Next check in {interval_seconds} seconds")
+            await asyncio.sleep(interval_seconds)
+
+    async def run_webhook(self, channel, safety_interval_seconds):
+        """
+        Syncs the documents paperless-ngx reports on the webhook `channel` as soon as they come in.
+        A full sync still runs every `safety_interval_seconds`, counted from the last full sync and
+        whether or not webhooks keep arriving, as a backstop for missed calls.
+        """
+        await self.sync()
+        last_full_sync = time.monotonic()
+        while True:
+            remaining = last_full_sync + safety_interval_seconds - time.monotonic()
+            document_ids = await channel.wait_for_documents(timeout=remaining) if remaining > 0 else set()
+            if document_ids:
+                self.log(f"Triggered by webhook for documents {sorted(document_ids)}")
+                await self.sync(document_ids)
+            if time.monotonic() - last_full_sync >= safety_interval_seconds:
+                self.log("Safety interval elapsed, running full sync...")
+                await self.sync()
+                last_full_sync = time.monotonic()
@@ -0,0 +1,118 @@
+import os
+import json
+from session_store import SessionStore, SESSION_STORE_KEY
+from webhook import WEBHOOK_TOKEN
+
+# Try to import the YAML parser, tenant files can always be written as JSON
+YAML_AVAILABLE = False
+try:
+    import yaml
+    YAML_AVAILABLE = True
+except ImportError:
+    pass
+
+TENANTS_FILE = os.getenv("TENANTS_FILE")
+TENANT_THREADS = int(os.getenv("TENANT_THREADS", 8))  # threads for the blocking calls of each tenant
+POLLING_INTERVAL = int(os.getenv("POLLING_INTERVAL", 60))
+
+REQUIRED_SETTINGS = ("name", "paperless_token", "paperless_url", "inbox_tag_id", "lexoffice_tag_id")
+
+
+class Tenant:
+    """
+    Settings of one paperless-ngx / lexoffice account pair. Files a tenant keeps (journal,
+    poller state, lock, tmp) live in its `data_dir`.
+    """
+
+    def __init__(self, name, paperless_token, paperless_url, inbox_tag_id, lexoffice_tag_id,
+                 lexoffice_username=None, lexoffice_password=None, custom_field_id_preview_url=None,
+                 polling_interval=POLLING_INTERVAL, data_dir="", session_store=None, webhook_token=WEBHOOK_TOKEN):
+        self.name = name
+        self.paperless_token = paperless_token
+        self.paperless_url = paperless_url
+        self.inbox_tag_id = inbox_tag_id
+        self.lexoffice_tag_id = lexoffice_tag_id
+        self.lexoffice_username = lexoffice_username
+        self.lexoffice_password = lexoffice_password
+        self.custom_field_id_preview_url = custom_field_id_preview_url
+        self.polling_interval = polling_interval
+        self.data_dir = data_dir
+        self.session_store = session_store or SessionStore()
+        self.webhook_token = webhook_token
+
+        if data_dir:
+            os.makedirs(data_dir, exist_ok=True)
+
+    def path(self, filename):
+        """
+        Path of one of the tenant's files. An absolute `filename` (e.g. a JOURNAL_FILE on a shared
+        volume) would be the same for all tenants, so tenants with a `data_dir` get their name added
+        to it: `/shared/journal.db` becomes `/shared/journal-<name>.db`.
+        """
+        if os.path.isabs(filename) and self.data_dir:
+            stem, extension = os.path.splitext(filename)
+            return f"{stem}-{self.name}{extension}"
+        return os.path.join(self.data_dir, filename)
+
+
+def tenant_from_env():
+    """The single tenant configured through environment variables, keeping its files in the working directory."""
+    return Tenant(
+        "default",
+        os.getenv('PAPERLESS_TOKEN'),
+        os.getenv('PAPERLESS_URL'),
+        os.getenv('INBOX_TAG_ID'),
+        os.getenv('LEXOFFICE_TAG_ID'),
+        lexoffice_username=os.getenv('LEXOFFICE_USERNAME'),
+        lexoffice_password=os.getenv('LEXOFFICE_PASSWORD'),
+        custom_field_id_preview_url=os.getenv('CUSTOM_FIELD_ID_PREVIEW_URL'),
+    )
+
+
+def _tenant_from_settings(settings):
+    missing = [key for key in REQUIRED_SETTINGS if not settings.get(key)]
+    if missing:
+        raise ValueError(f"Tenant {settings.get('name', '?')} is missing the settings {missing}")
+
+    # Secrets can be kept out of the file as ${VARIABLE} references to the environment
+    settings = {key: os.path.expandvars(value) if isinstance(value, str) else value for key, value in settings.items()}
+    data_dir = settings.get("data_dir") or os.path.join("data", settings["name"])
+    session_key = settings.get("lexoffice_session_key", SESSION_STORE_KEY)
+    return Tenant(
+        settings["name"],
+        settings["paperless_token"],
+        settings["paperless_url"],
+        settings["inbox_tag_id"],
+        settings["lexoffice_tag_id"],
+        lexoffice_username=settings.get("lexoffice_username"),
+        lexoffice_password=settings.get("lexoffice_password"),
+        custom_field_id_preview_url=settings.get("custom_field_id_preview_url"),
+        polling_interval=int(settings.get("polling_interval", POLLING_INTERVAL)),
+        data_dir=data_dir,
+        session_store=SessionStore(os.path.join(data_dir, "lexoffice-session.bin"), session_key),
+        webhook_token=settings.get("webhook_token", WEBHOOK_TOKEN),
+    )
+
+
+def load_tenants(path=TENANTS_FILE):
+    """
+    Reads the tenants from a JSON or YAML file holding a list of tenant settings, either at the
+    top level or under `tenants`. Raises ValueError for invalid files.
+    """
+    with open(path) as f:
+        if path.endswith((".yml", ".yaml")):
+            if not YAML_AVAILABLE:
+                raise ValueError("Reading YAML tenant files requires PyYAML, install it or use JSON")
+            config = yaml.safe_load(f)
+        else:
+            config = json.load(f)
+
+    entries = config.get("tenants", []) if isinstance(config, dict) else config
+    tenants = [_tenant_from_settings(entry) for entry in entries or []]
+    if not tenants:
+        raise ValueError(f"No tenants configured in {path}")
+
+    names = [tenant.name for tenant in tenants]
+    if len(set(names)) != len(names):
+        raise ValueError(f"Tenant names must be unique, got {names}")
+    return tenants
@@ -0,0 +1,182 @@
+import os
+import re
+import json
+import asyncio
+import urllib.parse
+
+WEBHOOK_HOST = os.getenv("WEBHOOK_HOST", "0.0.0.0")
+WEBHOOK_PORT = int(os.getenv("WEBHOOK_PORT", 8080))
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "/webhook")
+WEBHOOK_TOKEN = os.getenv("WEBHOOK_TOKEN")
+WEBHOOK_DEBOUNCE = float(os.getenv("WEBHOOK_DEBOUNCE", 5))  # seconds of quiet before a batch is synced
+WEBHOOK_MAX_DELAY = float(os.getenv("WEBHOOK_MAX_DELAY", 30))  # seconds a batch waits at most
+
+MAX_BODY_SIZE = 64 * 1024
+
+DOCUMENT_URL_PATTERN = re.compile(r"/documents/(\d+)")
+
+
+def extract_document_ids(payload):
+    """
+    Picks the document IDs out of a webhook payload. Understands `document_id`, `doc_id`,
+    `id` and `documents` fields as well as the `doc_url` placeholder paperless-ngx
+    workflows offer, e.g. a body of {"doc_url": "{doc_url}"}.
+    """
+    document_ids = set()
+    for key in ("document_id", "doc_id", "id", "documents"):
+        values = payload.get(key)
+        values = values if isinstance(values, list) else [values]
+        document_ids.update(int(value) for value in values if str(value).isdigit())
+
+    for key in ("doc_url", "url"):
+        values = payload.get(key)
+        values = values if isinstance(values, list) else [values]
+        for value in values:
+            match = DOCUMENT_URL_PATTERN.search(str(value or ""))
+            if match:
+                document_ids.add(int(match.group(1)))
+    return document_ids
+
+
+def _parse_body(body, content_type):
+    if "json" in content_type:
+        payload = json.loads(body or b"{}")
+        return payload if isinstance(payload, dict) else {"documents": payload}
+    # paperless-ngx sends form fields unless the workflow is set to send JSON
+    return {key: values if len(values) > 1 else values[0]
+            for key, values in urllib.parse.parse_qs(body.decode()).items()}
+
+
+class WebhookChannel:
+    """
+    Document IDs posted to one webhook path. They are coalesced: a batch is handed out once
+    no new ID arrived for `debounce` seconds, or at the latest `max_delay` seconds after its
+    first ID.
+    """
+
+    def __init__(self, path, token=WEBHOOK_TOKEN, debounce=WEBHOOK_DEBOUNCE, max_delay=WEBHOOK_MAX_DELAY):
+        self.path = path
+        self.token = token
+        self.debounce = debounce
+        self.max_delay = max_delay
+        self._pending = set()
+        self._received = asyncio.Event()
+
+    def add(self, document_ids):
+        self._pending.update(document_ids)
+        self._received.set()
+
+    async def wait_for_documents(self, timeout):
+        """
+        Waits up to `timeout` seconds for webhook calls and returns the coalesced set of
+        document IDs, or an empty set if none arrived in time.
+        """
+        try:
+            await asyncio.wait_for(self._received.wait(), timeout)
+        except asyncio.TimeoutError:
+            return set()
+
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + self.max_delay
+        while True:
+            self._received.clear()
+            remaining = deadline - loop.time()
+            if remaining <= 0:
+                break
+            try:
+                await asyncio.wait_for(self._received.wait(), min(self.debounce, remaining))
+            except asyncio.TimeoutError:
+                break
+
+        self._received.clear()
+        document_ids, self._pending = self._pending, set()
+        return document_ids
+
+    def authorized(self, query, headers):
+        if not self.token:
+            return True
+        return (headers.get("authorization") == f"Bearer {self.token}"
+                or query.get("token", [None])[0] == self.token)
+
+
+class WebhookReceiver:
+    """
+    Minimal HTTP endpoint for paperless-ngx workflow webhooks (document added / updated),
+    serving one channel per path, e.g. one per tenant.
+    """
+
+    def __init__(self, host=WEBHOOK_HOST, port=WEBHOOK_PORT):
+        self.host = host
+        self.port = port
+        self.channels = {}
+        self._server = None
+
+    def channel(self, path=WEBHOOK_PATH, token=WEBHOOK_TOKEN):
+        """Returns the channel receiving the document IDs posted to `path`."""
+        if path not in self.channels:
+            self.channels[path] = WebhookChannel(path, token)
+        return self.channels[path]
+
+    async def start(self):
+        self._server = await asyncio.start_server(self._handle, self.host, self.port)
+        for path in self.channels:
+            print(f"[Webhook] Listening on {self.host}:{self.port}{path}")
+
+    async def stop(self):
+        if self._server:
+            self._server.close()
+            await self._server.wait_closed()
+
+    async def _handle(self, reader, writer):
+        try:
+            request_line = (await reader.readline()).decode("latin-1").split()
+            headers = {}
+            while (line := await reader.readline()) not in (b"\r\n", b"\n", b""):
+                name, _, value = line.decode("latin-1").partition(":")
+                headers[name.strip().lower()] = value.strip()
+
+            length = int(headers.get("content-length", 0))
+            if length > MAX_BODY_SIZE:
+                return await self._respond(writer, 413, "Payload Too Large")
+            body = await reader.readexactly(length) if length else b""
+
+            if len(request_line) < 2:
+                return await self._respond(writer, 400, "Bad Request")
+            method, target = request_line[0], urllib.parse.urlsplit(request_line[1])
+            query = urllib.parse.parse_qs(target.query)
+
+            channel = self.channels.get(target.path)
+            if channel is None:
+                return await self._respond(writer, 404, "Not Found")
+            if method != "POST":
+                return await self._respond(writer, 405, "Method Not Allowed")
+            if not channel.authorized(query, headers):
+                return await self._respond(writer, 401, "Unauthorized")
+
+            try:
+                document_ids = extract_document_ids(_parse_body(body, headers.get("content-type", "")))
+            except (ValueError, UnicodeDecodeError) as e:
+                print(f"[Webhook] Could not parse payload: {e}")
+                return await self._respond(writer, 400, "Bad Request")
+
+            if not document_ids:
+                print(f"[Webhook] Payload without document ID: {body[:200]}")
+                return await self._respond(writer, 422, "No document ID")
+
+            print(f"[Webhook] Received documents {sorted(document_ids)} on {target.path}")
+            channel.add(document_ids)
+            await self._respond(writer, 202, "Accepted")
+        except (asyncio.IncompleteReadError, ConnectionError, ValueError) as e:
+            print(f"[Webhook] Error handling request: {e}")
+        finally:
+            writer.close()
+
+    async def _respond(self, writer, status, reason):
+        body = json.dumps({"status": reason}).encode()
+        writer.write(
+            f"HTTP/1.1 {status} {reason}\r\n"
+            "Content-Type: application/json\r\n"
+            f"Content-Length: {len(body)}\r\n"
+            "Connection: close\r\n\r\n".encode() + body
+        )
+        await writer.drain()